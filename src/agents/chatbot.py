@@ -1,24 +1,49 @@
-from typing import Dict, Any, List, Annotated, TypedDict, Sequence
+import asyncio
+import hashlib
+import re
+import httpx
+import numpy as np
+from collections import OrderedDict
+from typing import Dict, Any, List, Annotated, AsyncIterator, Optional, Tuple, TypedDict, Sequence
 from langchain_core.messages import BaseMessage, HumanMessage, AIMessage
 from langchain_groq import ChatGroq
 from langgraph.graph import StateGraph, END
-from groq import Groq
+from langgraph.types import StreamWriter
 from ..config.settings import (
     GROQ_API_KEY,
-    DEFAULT_MODEL,
-    DEFAULT_TEMPERATURE,
-    MAX_TOKENS
+    DEFAULT_TEMPERATURE
 )
-from src.config.settings import LLM_MODEL
+from src.config.settings import (
+    HTTP_KEEPALIVE_CONNECTIONS,
+    LLM_MODEL,
+    MAX_HISTORY_LENGTH,
+    STREAM_BATCH_GROWTH,
+    STREAM_MAX_BATCH,
+    SUMMARY_CACHE_SIZE
+)
+from src.database.vector_store import VectorStore
 from src.memory.knowledge_base import KnowledgeBase
+from src.memory.semantic_cache import SemanticCache
 from src.agents.validator import ValidationAgent
 
+SYSTEM_PROMPT = (
+    "You are an adaptive and helpful chatbot assistant. "
+    "Respond to the user's message thoughtfully.\n"
+    "Always be accurate, helpful, and adapt to the user's preferences."
+)
+
+# Inputs with numbers (e.g. a CNH registro) must not match a cached answer
+# given for similar text with different numbers
+DIGIT_RE = re.compile(r"\d")
+
 
 class ChatState(TypedDict):
     messages: Annotated[Sequence[BaseMessage], "The messages in the conversation"]
     validated_facts: Annotated[List[str], "Validated facts from the conversation"]
     preferences: Annotated[Dict[str, Any], "User preferences"]
     current_input: Annotated[str, "The current user input"]
+    relevant_facts: Annotated[List[str], "Stored facts relevant to the current input"]
+    query_embedding: Annotated[Optional[np.ndarray], "Embedding of the current input"]
     knowledge_base: Annotated[Any, "The knowledge base instance"]
     response: Annotated[str, "The response to return to the user"]
 
@@ -26,154 +51,271 @@ class ChatState(TypedDict):
 class ChatbotAgent:
     """Adaptive chatbot agent built with LangGraph."""
 
-    def __init__(self):
-        """Initialize the chatbot agent."""
-        self.knowledge_base = KnowledgeBase()
-        self.validator = ValidationAgent(self.knowledge_base)
+    def __init__(
+        self,
+        vector_store: Optional[VectorStore] = None,
+        http_client: Optional[httpx.Client] = None,
+        http_async_client: Optional[httpx.AsyncClient] = None
+    ):
+        """Initialize the chatbot agent.
+
+        Preferences, the semantic cache and history summaries belong to the
+        agent, so each conversation needs its own agent; the heavy vector
+        store and the HTTP connection pools can be shared between them.
+
+        Args:
+            vector_store: Shared vector store, created when omitted
+            http_client: Shared sync HTTP client, created when omitted
+            http_async_client: Shared async HTTP client, created when omitted
+        """
+        self.knowledge_base = KnowledgeBase(vector_store)
+        limits = httpx.Limits(max_keepalive_connections=HTTP_KEEPALIVE_CONNECTIONS)
+        self.http_client = http_client or httpx.Client(limits=limits)
+        self.http_async_client = http_async_client or httpx.AsyncClient(limits=limits)
+        self.validator = ValidationAgent(self.knowledge_base, http_client=self.http_client)
+        self.semantic_cache = SemanticCache()
+        # Summaries keyed by a digest of the messages they cover
+        self._history_summaries: "OrderedDict[str, str]" = OrderedDict()
         self.llm = ChatGroq(
             api_key=GROQ_API_KEY,
             model_name=LLM_MODEL,
-            temperature=0.7,
+            temperature=DEFAULT_TEMPERATURE,
+            http_client=self.http_client,
+            http_async_client=self.http_async_client,
         )
 
         self.workflow = self._build_graph()
 
-        self.client = Groq(api_key=GROQ_API_KEY)
-        self.model_name = DEFAULT_MODEL
-        self.temperature = DEFAULT_TEMPERATURE
-        self.setup_graph()
-
     def _build_graph(self) -> StateGraph:
         """Build the state graph for the agent.
         Returns:
             StateGraph instance
         """
         builder = StateGraph(ChatState)
-        builder.add_node("validate_input", self._validate_input)
-        builder.add_node("process_preferences", self._process_preferences)
-        builder.add_node("retrieve_context", self._retrieve_context)
+        builder.add_node("prepare_context", self._prepare_context)
         builder.add_node("generate_response", self._generate_response)
-        builder.add_edge("validate_input", "process_preferences")
-        builder.add_edge("process_preferences", "retrieve_context")
-        builder.add_edge("retrieve_context", "generate_response")
+        builder.add_edge("prepare_context", "generate_response")
         builder.add_edge("generate_response", END)
-        builder.set_entry_point("validate_input")
+        builder.set_entry_point("prepare_context")
 
         return builder.compile()
 
-    async def _validate_input(self, state: ChatState) -> ChatState:
-        """Validate the user input and extract facts and preferences.
+    async def _prepare_context(self, state: ChatState) -> Dict[str, Any]:
+        """Validate the input, store preferences and retrieve context concurrently.
         Args:
             state: Current state
         Returns:
-            Updated state
+            State update with validated facts, preferences and context
         """
         current_input = state["current_input"]
         messages = state["messages"]
-        result = await self.validator.process(current_input, messages)
-        validated_facts = state.get("validated_facts", []) + result.get("validated_facts", [])
-        return {
-            **state,
-            "validated_facts": validated_facts,
-        }
-
-    async def _process_preferences(self, state: ChatState) -> ChatState:
-        """Process and store user preferences.
-        Args:
-            state: Current state
-        Returns:
-            Updated state
-        """
-        current_input = state["current_input"]
         knowledge_base = state["knowledge_base"]
-        preference = knowledge_base.identify_preference(current_input, self.llm)
+        result, (query_embedding, relevant_facts) = await asyncio.gather(
+            self.validator.process(current_input, messages),
+            self._retrieve_context(knowledge_base, current_input),
+        )
+        validated_facts = state.get("validated_facts", []) + result.get("validated_facts", [])
+        preference = result.get("preference")
         if preference:
             pref_type = preference.get("type")
             pref_value = preference.get("value")
             if pref_type and pref_value:
-                knowledge_base.add_preference(pref_type, pref_value)
+                await asyncio.to_thread(knowledge_base.add_preference, pref_type, pref_value)
         preferences = knowledge_base.get_preferences()
         return {
-            **state,
+            "validated_facts": validated_facts,
             "preferences": preferences,
+            "relevant_facts": relevant_facts,
+            "query_embedding": query_embedding,
         }
 
-    async def _retrieve_context(self, state: ChatState) -> ChatState:
-        """Retrieve relevant context for the response.
+    async def _retrieve_context(
+        self,
+        knowledge_base: KnowledgeBase,
+        query: str
+    ) -> Tuple[np.ndarray, List[str]]:
+        """Embed the input once and retrieve the facts relevant to it.
         Args:
-            state: Current state
+            knowledge_base: Knowledge base to search
+            query: The user input
         Returns:
-            Updated state with context
+            Tuple of (query embedding, relevant facts)
         """
-        current_input = state["current_input"]
-        knowledge_base = state["knowledge_base"]
-        relevant_facts = knowledge_base.get_relevant_facts(current_input)
-        return {
-            **state,
-            "relevant_facts": relevant_facts,
-        }
+        query_embedding = await asyncio.to_thread(
+            knowledge_base.vector_store.embeddings.embed_query, query
+        )
+        relevant_facts = await asyncio.to_thread(
+            knowledge_base.get_relevant_facts, query, query_embedding=query_embedding
+        )
+        return query_embedding, relevant_facts
 
-    async def _generate_response(self, state: ChatState) -> ChatState:
+    async def _generate_response(self, state: ChatState, writer: StreamWriter) -> Dict[str, Any]:
         """Generate a response based on the context and preferences.
+
+        The response is streamed through the graph's custom stream in batches
+        that grow geometrically, so the first tokens are emitted right away.
+        The semantic cache is only used when there is no history and the
+        input has no digits, which never happens on the Streamlit chat path.
+
         Args:
             state: Current state
+            writer: Stream writer receiving the response chunks
         Returns:
-            Updated state with response
+            State update with the response
         """
         current_input = state["current_input"]
         messages = state["messages"]
         preferences = state.get("preferences", {})
         relevant_facts = state.get("relevant_facts", [])
-        
-        preference_instructions = ""
-        for pref_type, pref_value in preferences.items():
-            preference_instructions += f"- {pref_type}: {pref_value}\n"
+
+        preference_instructions = "\n".join(
+            f"- {pref_type}: {pref_value}" for pref_type, pref_value in preferences.items()
+        ) or "No specific preferences set yet."
 
         fact_context = ""
         if relevant_facts:
-            fact_context = "Based on these facts I've learned:\n"
-            for fact in relevant_facts:
-                fact_context += f"- {fact}\n"
-
-        system_prompt = f"""
-        You are an adaptive and helpful chatbot assistant. Respond to the user's message thoughtfully.
+            fact_context = "Based on these facts I've learned:\n" + "\n".join(
+                f"- {fact}" for fact in relevant_facts
+            )
 
-        {fact_context if fact_context else ""}
+        context_prompt = f"""
+        {fact_context}
 
         User preferences:
-        {preference_instructions if preference_instructions else "No specific preferences set yet."}
-
-        Always be accurate, helpful, and adapt to the user's preferences.
+        {preference_instructions}
         """
 
+        # Only self-contained turns are cached; with history the same words
+        # can ask something else
+        cacheable = not messages and not DIGIT_RE.search(current_input)
+        if cacheable:
+            embedding = state.get("query_embedding")
+            if embedding is None:
+                embedding = await asyncio.to_thread(
+                    self.knowledge_base.vector_store.embeddings.embed_query, current_input
+                )
+            cached_response = self.semantic_cache.lookup(embedding, context_prompt)
+            if cached_response is not None:
+                writer(cached_response)
+                return {"response": cached_response}
+
+        # The static prompt, summary and earlier turns form a prefix that stays
+        # identical across turns, so the per-turn context goes last.
         history = [
-            {"role": "system", "content": system_prompt}
+            {"role": "system", "content": SYSTEM_PROMPT}
         ]
 
-        for message in messages:
+        summary, recent_messages = await self._compress_history(messages)
+        if summary:
+            history.append({"role": "system", "content": f"[Previous context: {summary}]"})
+
+        for message in recent_messages:
             if isinstance(message, HumanMessage):
                 history.append({"role": "user", "content": message.content})
             elif isinstance(message, AIMessage):
                 history.append({"role": "assistant", "content": message.content})
+        history.append({"role": "system", "content": context_prompt})
         history.append({"role": "user", "content": current_input})
-        response = self.llm.invoke(history)
+        chunks = []
+        buffer = []
+        batch_size = 1
+        async for chunk in self.llm.astream(history):
+            if not chunk.content:
+                continue
+            chunks.append(chunk.content)
+            buffer.append(chunk.content)
+            if len(buffer) >= batch_size:
+                writer("".join(buffer))
+                buffer = []
+                batch_size = min(batch_size * STREAM_BATCH_GROWTH, STREAM_MAX_BATCH)
+        if buffer:
+            writer("".join(buffer))
+
+        response = "".join(chunks)
+        if cacheable:
+            self.semantic_cache.add(embedding, current_input, response, context_prompt)
+
+        return {"response": response}
+
+    async def _compress_history(
+        self,
+        messages: Sequence[BaseMessage]
+    ) -> Tuple[Optional[str], Sequence[BaseMessage]]:
+        """Keep the latest messages verbatim and summarize the older ones.
 
-        return {
-            **state,
-            "response": response.content,
-        }
+        Summaries are cached per conversation prefix, so only the messages
+        that rolled off the window since the last summary of the same
+        conversation are summarized again.
 
-    async def chat(self, message: str, history: List[BaseMessage]) -> str:
-        """Process a user message and generate a response.
+        Args:
+            messages: Chat history
+
+        Returns:
+            Tuple of (summary of older messages or None, recent messages)
+        """
+        if len(messages) <= MAX_HISTORY_LENGTH:
+            return None, messages
+
+        older = messages[:-MAX_HISTORY_LENGTH]
+        digests = self._prefix_digests(older)
+        summarized_upto = next(
+            (end for end in range(len(older), 0, -1) if digests[end] in self._history_summaries),
+            0
+        )
+        summary = self._history_summaries.get(digests[summarized_upto], "")
+        if summarized_upto < len(older):
+            summary = await self._summarize(summary, older[summarized_upto:])
+        self._history_summaries[digests[-1]] = summary
+        self._history_summaries.move_to_end(digests[-1])
+        if len(self._history_summaries) > SUMMARY_CACHE_SIZE:
+            self._history_summaries.popitem(last=False)
+
+        return summary, messages[-MAX_HISTORY_LENGTH:]
+
+    @staticmethod
+    def _prefix_digests(messages: Sequence[BaseMessage]) -> List[str]:
+        """Hash every prefix of the messages; entry i covers the first i messages."""
+        running = hashlib.sha256()
+        digests = [running.hexdigest()]
+        for message in messages:
+            running.update(f"{message.type}\0{message.content}\0".encode("utf-8"))
+            digests.append(running.hexdigest())
+        return digests
+
+    async def _summarize(self, previous_summary: str, messages: Sequence[BaseMessage]) -> str:
+        """Fold messages that left the history window into the running summary.
 
         Args:
-            message: User message
-            history: Chat history
+            previous_summary: Summary of even older messages, may be empty
+            messages: Messages to add to the summary
 
         Returns:
-            Generated response
+            Updated summary
+        """
+        transcript = "\n".join(
+            f"User: {message.content}" if isinstance(message, HumanMessage)
+            else f"Assistant: {message.content}"
+            for message in messages
+            if isinstance(message, (HumanMessage, AIMessage))
+        )
+
+        prompt = f"""
+        Summarize the conversation below in at most 200 tokens.
+        Keep facts, decisions and user preferences; drop greetings and small talk.
+
+        Existing summary: {previous_summary if previous_summary else "None"}
+
+        New messages:
+        {transcript}
+
+        Summary:
         """
-        state = {
+        response = await self.llm.ainvoke(prompt)
+        return response.content.strip()
+
+    def _initial_state(self, message: str, history: List[BaseMessage]) -> ChatState:
+        """Build the workflow input state for a user message."""
+        return {
             "messages": history,
             "validated_facts": [],
             "preferences": self.knowledge_base.get_preferences(),
@@ -181,97 +323,36 @@ class ChatbotAgent:
             "knowledge_base": self.knowledge_base,
             "response": ""
         }
-        final_state = await self.workflow.ainvoke(state)
+
+    async def chat(self, message: str, history: List[BaseMessage]) -> str:
+        """Process a user message and generate a response.
+
+        Args:
+            message: User message
+            history: Chat history
+
+        Returns:
+            Generated response
+        """
+        final_state = await self.workflow.ainvoke(self._initial_state(message, history))
         return final_state.get("response", "I'm not sure how to respond to that.")
 
-    def _convert_messages_to_groq_format(
-        self,
-        messages: List[HumanMessage | AIMessage]
-    ) -> List[Dict]:
-        """Converts LangChain messages to Groq format."""
-        groq_messages = []
-        for msg in messages:
-            if isinstance(msg, HumanMessage):
-                groq_messages.append({"role": "user", "content": msg.content})
-            elif isinstance(msg, AIMessage):
-                groq_messages.append(
-                    {"role": "assistant", "content": msg.content}
-                )
-        return groq_messages
+    async def stream_chat(self, message: str, history: List[BaseMessage]) -> AsyncIterator[str]:
+        """Process a user message and stream the generated response.
 
-    def _get_groq_response(
-        self,
-        messages: List[HumanMessage | AIMessage],
-        temperature: float | None = None,
-        max_tokens: int = MAX_TOKENS
-    ) -> str:
-        """Get response from Groq API."""
-        groq_messages = self._convert_messages_to_groq_format(messages)
-        temp = temperature if temperature is not None else self.temperature
-
-        completion = self.client.chat.completions.create(
-            model=self.model_name,
-            messages=groq_messages,
-            temperature=temp,
-            max_tokens=max_tokens,
-            top_p=1,
-            stream=False
-        )
+        Args:
+            message: User message
+            history: Chat history
 
-        return completion.choices[0].message.content
-
-    def setup_graph(self):
-        """Configure the message processing graph."""
-        def route_message(state: Dict) -> str:
-            """Route the message to the appropriate node."""
-            message = state["messages"][-1].content.lower()
-
-            if "corrigir" in message or "correção" in message:
-                return "correction"
-            elif "preferência" in message or "preferir" in message:
-                return "preference"
-            return "chat"
-
-        def process_chat(state: Dict) -> Dict:
-            """Process normal chat message."""
-            messages = state["messages"]
-            response = self._get_groq_response(messages)
-            return {"messages": messages + [AIMessage(content=response)]}
-
-        def process_correction(state: Dict) -> Dict:
-            """Process user corrections."""
-            messages = state["messages"]
-            response = "Thank you for the correction! I will learn from it."
-            return {"messages": messages + [AIMessage(content=response)]}
-
-        def process_preference(state: Dict) -> Dict:
-            """Process user preferences."""
-            messages = state["messages"]
-            response = "I understand your preference! I will adapt to it."
-            return {"messages": messages + [AIMessage(content=response)]}
-
-        workflow = StateGraph(ChatState)
-        workflow.add_node("route", route_message)
-        workflow.add_node("chat", process_chat)
-        workflow.add_node("correction", process_correction)
-        workflow.add_node("preference", process_preference)
-
-        workflow.add_edge("route", "chat")
-        workflow.add_edge("route", "correction")
-        workflow.add_edge("route", "preference")
-        workflow.add_edge("chat", "route")
-        workflow.add_edge("correction", "route")
-        workflow.add_edge("preference", "route")
-        
-        workflow.set_entry_point("route")
-        self.graph = workflow.compile()
-
-    def process_message(self, message: str) -> str:
-        """Process a user message and return the response."""
-        state = {"messages": [HumanMessage(content=message)]}
-        result = self.graph.invoke(state)
-        return result["messages"][-1].content
+        Yields:
+            Chunks of the generated response
+        """
+        async for chunk in self.workflow.astream(
+            self._initial_state(message, history),
+            stream_mode="custom"
+        ):
+            yield chunk
 
     def update_temperature(self, temperature: float):
         """Update the model temperature."""
-        self.temperature = temperature
+        self.llm.temperature = temperature
@@ -1,24 +1,44 @@
-from typing import Dict, Any, List
+import asyncio
+import re
+from typing import Dict, Any, List, Optional
+import httpx
 from langchain_core.messages import BaseMessage
 from langchain_groq import ChatGroq
-from src.config.settings import GROQ_API_KEY, LLM_MODEL
+from src.config.settings import (
+    GROQ_API_KEY,
+    LLM_MODEL,
+    MAX_EXTRACTED_FACTS,
+    MIN_FACT_MESSAGE_LENGTH
+)
 from src.memory.knowledge_base import KnowledgeBase
+from src.utils.llm_json import JSON_ARRAY_RE, parse_llm_json
+
+DECLARATIVE_RE = re.compile(
+    r"\b(is|are|was|were|has|have|will|can|é|são|foi|foram|era|eram|tem|têm|possui|possuem)\b",
+    re.IGNORECASE,
+)
+GREETING_RE = re.compile(
+    r"^\s*(hi|hello|hey|thanks|thank you|bye|oi|olá|ola|obrigad[oa]|valeu|tchau|bom dia|boa tarde|boa noite)\b",
+    re.IGNORECASE,
+)
 
 
 class ValidationAgent:
     """Agent responsible for validating user inputs and identifying factual statements."""
 
-    def __init__(self, knowledge_base: KnowledgeBase):
+    def __init__(self, knowledge_base: KnowledgeBase, http_client: Optional[httpx.Client] = None):
         """Initialize the validation agent.
 
         Args:
             knowledge_base: Knowledge base for storing validated facts
+            http_client: Shared HTTP client so Groq connections are kept alive
         """
         self.knowledge_base = knowledge_base
         self.llm = ChatGroq(
             api_key=GROQ_API_KEY,
             model_name=LLM_MODEL,
             temperature=0.2,
+            http_client=http_client,
         )
 
     async def process(self, message: str, chat_history: List[BaseMessage]) -> Dict[str, Any]:
@@ -29,19 +49,24 @@ class ValidationAgent:
         Returns:
             Dict with processing results
         """
-        # Check for preferences
-        preference = self.knowledge_base.identify_preference(message, self.llm)
+        # Check for preferences and extract potential factual statements concurrently
+        preference, facts = await asyncio.gather(
+            asyncio.to_thread(self.knowledge_base.identify_preference, message, self.llm),
+            asyncio.to_thread(self._extract_potential_facts, message),
+        )
 
-        # Extract potential factual statements
-        facts = self._extract_potential_facts(message)
+        # Validate all potential facts with a single call
+        validations = await asyncio.to_thread(
+            self.knowledge_base.validate_facts_batch, facts, self.llm
+        )
+        valid_facts = [
+            fact for fact, (is_valid, reason) in zip(facts, validations) if is_valid
+        ]
         validated_facts = []
-
-        # Validate each potential fact
-        for fact in facts:
-            is_valid, reason = self.knowledge_base.validate_fact(fact, self.llm)
-            if is_valid:
-                self.knowledge_base.add_fact(fact, validated=True)
-                validated_facts.append(fact)
+        if valid_facts:
+            validated_facts = await asyncio.to_thread(
+                self.knowledge_base.add_facts, valid_facts, validated=True
+            )
 
         return {
             "message": message,
@@ -56,6 +81,14 @@ class ValidationAgent:
         Returns:
             List of potential factual statements
         """
+        stripped = message.strip()
+        if (
+            len(stripped) < MIN_FACT_MESSAGE_LENGTH
+            or (stripped.endswith("?") and not DECLARATIVE_RE.search(stripped))
+            or GREETING_RE.match(stripped)
+        ):
+            return []
+
         prompt = f"""
         Extract any factual claims from the following message. A factual claim is a statement
         that asserts something about the world that can be verified as true or false.        
@@ -68,20 +101,7 @@ class ValidationAgent:
         """
         response = self.llm.invoke(prompt)
         try:
-            import json
-            response_text = response.content
-            if "```json" in response_text:
-                json_text = response_text.split("```json")[1].split("```")[0].strip()
-            elif "```" in response_text:
-                json_text = response_text.split("```")[1].strip()
-            else:
-                import re
-                json_match = re.search(r'\[.*\]', response_text, re.DOTALL)
-                if json_match:
-                    json_text = json_match.group(0)
-                else:
-                    return []
-            facts_list = json.loads(json_text)
-            return facts_list if isinstance(facts_list, list) else []
-        except Exception as e:
-            return e
+            facts_list = parse_llm_json(response.content, JSON_ARRAY_RE)
+            return facts_list[:MAX_EXTRACTED_FACTS] if isinstance(facts_list, list) else []
+        except Exception:
+            return []
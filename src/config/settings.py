@@ -17,5 +17,24 @@ LLM_MODEL = os.getenv("LLM_MODEL", "llama3-8b-8192")
 VECTOR_DB_HOST = os.getenv("VECTOR_DB_HOST", "localhost")
 VECTOR_DB_PORT = int(os.getenv("VECTOR_DB_PORT", "6379"))
 MAX_HISTORY_LENGTH = 10
-EMBEDDING_DIMENSION = 1536
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+EMBEDDING_DIMENSION = 384
+EMBEDDING_BATCH_SIZE = 64
 SIMILARITY_THRESHOLD = 0.75
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.87"))
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", "1000"))
+STREAM_BATCH_GROWTH = 3
+STREAM_MAX_BATCH = 50
+HTTP_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_KEEPALIVE_CONNECTIONS", "10"))
+PERSIST_INTERVAL_SECONDS = float(os.getenv("PERSIST_INTERVAL_SECONDS", "5"))
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 64
+PREFERENCE_CACHE_SIZE = 1024
+MIN_FACT_MESSAGE_LENGTH = 15
+MAX_EXTRACTED_FACTS = 8
+OCR_TESSDATA_PATH = os.getenv("OCR_TESSDATA_PATH", "")
+OCR_CACHE_DIR = os.getenv("OCR_CACHE_DIR", os.path.expanduser("~/.cache/cnh_ocr"))
+SUMMARY_CACHE_SIZE = 256
+OCR_CACHE_TTL_SECONDS = float(os.getenv("OCR_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+OCR_CACHE_MAX_ENTRIES = int(os.getenv("OCR_CACHE_MAX_ENTRIES", "500"))
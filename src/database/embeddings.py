@@ -0,0 +1,55 @@
+import threading
+from typing import List
+import numpy as np
+from sentence_transformers import SentenceTransformer
+from src.config.settings import EMBEDDING_MODEL, EMBEDDING_BATCH_SIZE
+
+
+class LocalEmbeddings:
+    """Local sentence-transformers encoder with the LangChain embeddings interface."""
+    def __init__(self, model_name: str = EMBEDDING_MODEL, batch_size: int = EMBEDDING_BATCH_SIZE):
+        """Initialize the embeddings.
+        Args:
+            model_name: Name of the sentence-transformers model
+            batch_size: Number of texts encoded per forward pass
+        """
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self._model = None
+        self._lock = threading.Lock()
+
+    @property
+    def model(self) -> SentenceTransformer:
+        """Load the model on first use."""
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    self._model = SentenceTransformer(self.model_name)
+        return self._model
+
+    def embed_documents(self, texts: List[str]) -> np.ndarray:
+        """Embed a batch of texts.
+
+        Args:
+            texts: The texts to embed
+
+        Returns:
+            Matrix of L2-normalized float32 embeddings, one row per text
+        """
+        return self.model.encode(
+            texts,
+            batch_size=self.batch_size,
+            normalize_embeddings=True,
+            convert_to_numpy=True,
+        )
+
+    def embed_query(self, text: str) -> np.ndarray:
+        """Embed a single query text.
+
+        Args:
+            text: The text to embed
+
+        Returns:
+            L2-normalized float32 embedding
+        """
+        return self.embed_documents([text])[0]
@@ -0,0 +1,170 @@
+import json
+import os
+from typing import BinaryIO, Callable, Dict, Iterable, Iterator, List, Sequence, Tuple
+import numpy as np
+
+
+def replace_file(path: str, write: Callable[[BinaryIO], None]) -> None:
+    """Write a file through a temporary sibling and atomically swap it in.
+
+    Replacing instead of truncating keeps existing memory maps of the old
+    file valid.
+
+    Args:
+        path: Destination path
+        write: Callback writing the file contents
+    """
+    os.replace(_write_temp(path, write), path)
+
+
+def replace_files(writes: Dict[str, Callable[[BinaryIO], None]], journal_path: str) -> None:
+    """Replace several files so that either all or none of them change.
+
+    Every file is first written and synced to a temporary sibling. The list
+    of files is then committed to a journal, and the temporaries are swapped
+    in. After a crash, recover_files() finishes the swap from the journal.
+
+    Args:
+        writes: Callback writing the new contents of each destination path
+        journal_path: Path of the journal recording the pending swap
+    """
+    for path, write in writes.items():
+        _write_temp(path, write, sync=True)
+    replace_file(journal_path, lambda f: f.write(json.dumps(list(writes)).encode("utf-8")))
+    recover_files(journal_path)
+
+
+def recover_files(journal_path: str) -> None:
+    """Finish a replace_files() swap interrupted by a crash, if any.
+
+    Args:
+        journal_path: Path of the journal recording the pending swap
+    """
+    if not os.path.exists(journal_path):
+        return
+    with open(journal_path, encoding="utf-8") as f:
+        paths = json.load(f)
+    for path in paths:
+        if os.path.exists(f"{path}.tmp"):
+            os.replace(f"{path}.tmp", path)
+    os.remove(journal_path)
+
+
+def _write_temp(path: str, write: Callable[[BinaryIO], None], sync: bool = False) -> str:
+    """Write a file to the temporary sibling of path and return its path."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        write(f)
+        if sync:
+            f.flush()
+            os.fsync(f.fileno())
+    return tmp_path
+
+
+class TextColumn:
+    """List of strings stored as a UTF-8 blob plus an array of byte offsets.
+
+    Saved texts stay on disk in a memory-mapped blob and are only decoded
+    when accessed; texts appended since the last save are held in memory.
+    """
+    def __init__(self, texts: Iterable[str] = ()):
+        """Initialize an in-memory column.
+        Args:
+            texts: Initial texts
+        """
+        self._blob = np.empty(0, dtype=np.uint8)
+        self._offsets = np.zeros(1, dtype=np.int64)
+        self._new: List[str] = list(texts)
+
+    @classmethod
+    def load(cls, blob_path: str, offsets_path: str) -> "TextColumn":
+        """Open a saved column without reading the texts.
+
+        Args:
+            blob_path: Path of the UTF-8 blob
+            offsets_path: Path of the .npy offsets array
+
+        Returns:
+            TextColumn backed by the files
+        """
+        column = cls()
+        column._offsets = np.load(offsets_path, mmap_mode="r")
+        column._map_blob(blob_path)
+        if len(column._blob) < column._offsets[-1]:
+            raise ValueError(f"{blob_path} is shorter than {offsets_path} records")
+        return column
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1 + len(self._new)
+
+    def __getitem__(self, idx: int) -> str:
+        idx = int(idx)
+        if idx < 0:
+            idx += len(self)
+        saved = len(self._offsets) - 1
+        if idx < saved:
+            start, end = self._offsets[idx], self._offsets[idx + 1]
+            return self._blob[start:end].tobytes().decode("utf-8")
+        return self._new[idx - saved]
+
+    def __iter__(self) -> Iterator[str]:
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def extend(self, texts: Iterable[str]) -> None:
+        """Append texts to the column."""
+        self._new.extend(texts)
+
+    def select(self, keep: Sequence[bool]) -> "TextColumn":
+        """Return an in-memory column with the texts whose keep flag is set."""
+        return TextColumn(text for text, kept in zip(self, keep) if kept)
+
+    def encode(self) -> Tuple[bytes, np.ndarray]:
+        """Encode every text into a fresh blob.
+
+        Returns:
+            Tuple of the UTF-8 blob and its offsets array
+        """
+        encoded = [text.encode("utf-8") for text in self]
+        return b"".join(encoded), self._offsets_after(np.zeros(1, dtype=np.int64), encoded)
+
+    def save(self, blob_path: str, offsets_path: str) -> None:
+        """Persist the texts appended since the last save.
+
+        The new texts are written to the end of the blob before the offsets
+        are replaced, so the offsets file always describes complete texts.
+        Rewriting the whole column goes through encode() instead.
+
+        Args:
+            blob_path: Path of the UTF-8 blob
+            offsets_path: Path of the .npy offsets array
+        """
+        if not os.path.exists(blob_path):
+            blob, offsets = self.encode()
+            replace_file(blob_path, lambda f: f.write(blob))
+        else:
+            encoded = [text.encode("utf-8") for text in self._new]
+            base = np.asarray(self._offsets, dtype=np.int64)
+            with open(blob_path, "r+b") as f:
+                f.seek(int(base[-1]))
+                f.truncate()
+                f.write(b"".join(encoded))
+            offsets = self._offsets_after(base, encoded)
+        replace_file(offsets_path, lambda f: np.save(f, offsets))
+
+        self._offsets = offsets
+        self._new = []
+        self._map_blob(blob_path)
+
+    @staticmethod
+    def _offsets_after(base: np.ndarray, encoded: List[bytes]) -> np.ndarray:
+        """Extend an offsets array with the sizes of encoded texts."""
+        sizes = np.fromiter((len(chunk) for chunk in encoded), dtype=np.int64, count=len(encoded))
+        return np.concatenate([base, base[-1] + np.cumsum(sizes)])
+
+    def _map_blob(self, blob_path: str) -> None:
+        """Memory-map the saved blob."""
+        if self._offsets[-1] > 0:
+            self._blob = np.memmap(blob_path, dtype=np.uint8, mode="r")
+        else:
+            self._blob = np.empty(0, dtype=np.uint8)
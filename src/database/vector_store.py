@@ -1,48 +1,157 @@
+import atexit
+import json
 import os
 import pickle
+import threading
+import time
+import weakref
 import faiss
 import numpy as np
-from typing import List, Dict, Any, Tuple
-from langchain_openai import OpenAIEmbeddings
+from contextlib import contextmanager
+from datetime import datetime
+from typing import List, Dict, Any, BinaryIO, Iterator, Optional, Sequence, Tuple
 from langchain_core.documents import Document
-from src.config.settings import GROQ_API_KEY, EMBEDDING_DIMENSION
+from src.database.embeddings import LocalEmbeddings
+from src.database.text_column import TextColumn, recover_files, replace_file, replace_files
+from src.config.settings import (
+    EMBEDDING_DIMENSION,
+    HNSW_EF_CONSTRUCTION,
+    HNSW_EF_SEARCH,
+    HNSW_M,
+    PERSIST_INTERVAL_SECONDS
+)
+
+DOCUMENT_TYPES = ("fact", "preference")
+TYPE_CODES = {name: code for code, name in enumerate(DOCUMENT_TYPES)}
+TYPE_OTHER = 255
+
+# Stores flushed at interpreter exit; weak so closed or dropped stores are freed
+_open_stores: "weakref.WeakSet[VectorStore]" = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_open_stores() -> None:
+    """Flush every vector store still open at interpreter exit."""
+    for store in list(_open_stores):
+        store.flush()
+
+
+class _AddBuffer(threading.local):
+    """Per-thread state of the buffered_add() blocks of a store."""
+    def __init__(self):
+        self.depth = 0
+        self.pending: List[Tuple[str, Dict[str, Any]]] = []
 
 
 class VectorStore:
-    """FAISS Vector Store for storing and retrieving knowledge embeddings."""
+    """FAISS Vector Store for storing and retrieving knowledge embeddings.
+    
+    Embeddings are L2-normalized and searched by inner product in an HNSW
+    graph, so search scores are cosine similarities. Vectors are stored as
+    FP16, halving index memory and bandwidth per query.
+    
+    Documents are kept column-wise: texts, the type code, the validated flag
+    and the timestamp live in parallel arrays, so metadata filters are NumPy
+    masks. Any other metadata goes to metadata_other.
+    
+    The in-memory index is authoritative. Changes are written to disk at most
+    once every PERSIST_INTERVAL_SECONDS, on flush() and at interpreter exit.
+    On disk, texts are a UTF-8 blob plus an offsets array that are memory
+    mapped at startup and decoded on demand, the numeric columns an .npz
+    archive and the remaining metadata a JSON-lines file.
+    """
     def __init__(self, index_path: str = "data/vector_index"):
         """Initialize the vector store.
         Args:
             index_path: Path to save and load the FAISS index
         """
         self.index_path = index_path
-        self.embeddings = OpenAIEmbeddings(openai_api_key=GROQ_API_KEY)
+        self._lock = threading.RLock()
+        self._add_buffer = _AddBuffer()
+        self.embeddings = LocalEmbeddings()
         os.makedirs(os.path.dirname(index_path), exist_ok=True)
         
+        self._dirty = False
+        self._rewrite_documents = False
+        self._last_flush = time.monotonic()
+        
+        self.texts = TextColumn()
+        self.meta_type = np.empty(0, dtype=np.uint8)
+        self.meta_validated = np.empty(0, dtype=bool)
+        self.timestamps = np.empty(0, dtype=np.int64)
+        self.metadata_other: List[Dict[str, Any]] = []
+        self._load_columns()
+        
         if os.path.exists(f"{index_path}.faiss"):
             self.index = faiss.read_index(f"{index_path}.faiss")
-            with open(f"{index_path}.pkl", "rb") as f:
-                self.documents = pickle.load(f)
         else:
-            self.index = faiss.IndexFlatL2(EMBEDDING_DIMENSION)
-            self.documents = []
+            self.index = self._new_index()
+        self._persisted_count = len(self.texts)
+        
+        if (
+            self.index.ntotal != len(self.texts) or
+            self.index.d != EMBEDDING_DIMENSION or
+            self.index.metric_type != faiss.METRIC_INNER_PRODUCT or
+            not isinstance(faiss.downcast_index(self.index), faiss.IndexHNSWSQ)
+        ):
+            self._rebuild_index()
+        
+        _open_stores.add(self)
+    
+    def close(self) -> None:
+        """Write pending changes and stop flushing the store at exit."""
+        self.flush()
+        _open_stores.discard(self)
     
     def add_text(self, text: str, metadata: Dict[str, Any]) -> None:
         """Add text to the vector store with associated metadata.
         
+        Inside a buffered_add() block of the calling thread the text is only
+        queued.
+        
         Args:
             text: The text to add
             metadata: Associated metadata for the text
         """
-        embedding = self.embeddings.embed_query(text)
-        embedding_np = np.array([embedding], dtype=np.float32)
+        buffer = self._add_buffer
+        if buffer.depth:
+            buffer.pending.append((text, metadata))
+            return
         
-        self.index.add(embedding_np)
+        self._add_batch([(text, metadata)])
+    
+    @contextmanager
+    def buffered_add(self) -> Iterator[None]:
+        """Queue add_text calls and add them in a single batch on exit.
         
-        doc = Document(page_content=text, metadata=metadata)
-        self.documents.append(doc)
+        All queued texts are embedded with one request, added to the index
+        at once and persisted a single time. Only the calling thread's
+        add_text calls are queued; other threads keep adding directly.
+        """
+        buffer = self._add_buffer
+        buffer.depth += 1
+        try:
+            yield
+        finally:
+            buffer.depth -= 1
+            pending = []
+            if not buffer.depth:
+                pending, buffer.pending = buffer.pending, []
+            if pending:
+                self._add_batch(pending)
+    
+    def _add_batch(self, items: List[Tuple[str, Dict[str, Any]]]) -> None:
+        """Embed and add (text, metadata) pairs to the index."""
+        embeddings = self.embeddings.embed_documents([text for text, _ in items])
+        embeddings_np = self._to_matrix(embeddings)
         
-        self._save_index()
+        with self._lock:
+            self.index.add(embeddings_np)
+            self._append_documents(items)
+            
+            self._dirty = True
+            if time.monotonic() - self._last_flush >= PERSIST_INTERVAL_SECONDS:
+                self.flush()
     
     def search(self, query: str, k: int = 3) -> List[Tuple[Document, float]]:
         """Search for similar documents.
@@ -50,35 +159,309 @@ class VectorStore:
         Args:
             query: The query text
             k: Number of results to return
-            
+        
+        Returns:
+            List of (document, similarity_score) tuples
+        """
+        if len(self.texts) == 0:
+            return []
+        
+        return self.search_by_vector(self.embeddings.embed_query(query), k)
+    
+    def search_by_vector(self, query_embedding: Sequence[float], k: int = 3) -> List[Tuple[Document, float]]:
+        """Search for documents similar to an already embedded query.
+        
+        Args:
+            query_embedding: Embedding of the query
+            k: Number of results to return
+        
         Returns:
             List of (document, similarity_score) tuples
         """
-        if len(self.documents) == 0:
+        if len(self.texts) == 0:
+            return []
+        
+        query_embedding_np = self._to_matrix([query_embedding])
+        with self._lock:
+            indices, similarities = self._search_ids(query_embedding_np, k)
+            return [
+                (self._document(idx), float(similarity))
+                for idx, similarity in zip(indices, similarities)
+            ]
+    
+    def search_texts(
+        self,
+        query: str,
+        k: int = 3,
+        doc_type: Optional[str] = None,
+        validated: Optional[bool] = None,
+        min_score: Optional[float] = None,
+        query_embedding: Optional[Sequence[float]] = None
+    ) -> List[str]:
+        """Search for similar documents and filter them by metadata.
+        
+        The filters are applied to the top k results as a single NumPy mask.
+        
+        Args:
+            query: The query text
+            k: Number of results to return before filtering
+            doc_type: Keep only documents of this type
+            validated: Keep only documents with this validated flag
+            min_score: Keep only documents scoring strictly above this similarity
+            query_embedding: Precomputed embedding of the query, if available
+        
+        Returns:
+            List of matching document texts
+        """
+        if len(self.texts) == 0:
             return []
         
-        query_embedding = self.embeddings.embed_query(query)
-        query_embedding_np = np.array([query_embedding], dtype=np.float32)
+        if query_embedding is None:
+            query_embedding = self.embeddings.embed_query(query)
+        query_embedding_np = self._to_matrix([query_embedding])
+        with self._lock:
+            indices, similarities = self._search_ids(query_embedding_np, k)
+            mask = np.ones(len(indices), dtype=bool)
+            if doc_type in TYPE_CODES:
+                mask &= self.meta_type[indices] == TYPE_CODES[doc_type]
+            elif doc_type is not None:
+                mask &= np.array(
+                    [self._metadata(idx).get("type") == doc_type for idx in indices],
+                    dtype=bool
+                )
+            if validated is not None:
+                mask &= self.meta_validated[indices] == validated
+            if min_score is not None:
+                mask &= similarities > min_score
+            return [self.texts[idx] for idx in indices[mask]]
+    
+    def _search_ids(self, query_embedding_np: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the positions and similarities of the nearest documents."""
+        k = min(k, len(self.texts))
+        similarities, indices = self.index.search(query_embedding_np, k)
+        found = indices[0] != -1
+        return indices[0][found], similarities[0][found]
+    
+    def _append_documents(self, items: List[Tuple[str, Dict[str, Any]]]) -> None:
+        """Append (text, metadata) pairs to the document columns."""
+        packed = [self._pack_metadata(metadata) for _, metadata in items]
+        self.texts.extend(text for text, _ in items)
+        self.meta_type = np.concatenate([
+            self.meta_type, np.array([p[0] for p in packed], dtype=np.uint8)
+        ])
+        self.meta_validated = np.concatenate([
+            self.meta_validated, np.array([p[1] for p in packed], dtype=bool)
+        ])
+        self.timestamps = np.concatenate([
+            self.timestamps, np.array([p[2] for p in packed], dtype=np.int64)
+        ])
+        self.metadata_other.extend(p[3] for p in packed)
+    
+    def _keep_documents(self, keep: np.ndarray) -> None:
+        """Drop the documents whose keep flag is False from the columns."""
+        self.texts = self.texts.select(keep)
+        self.meta_type = self.meta_type[keep]
+        self.meta_validated = self.meta_validated[keep]
+        self.timestamps = self.timestamps[keep]
+        self.metadata_other = [
+            other for other, kept in zip(self.metadata_other, keep) if kept
+        ]
+    
+    @staticmethod
+    def _pack_metadata(metadata: Dict[str, Any]) -> Tuple[int, bool, int, Dict[str, Any]]:
+        """Split metadata into (type code, validated, timestamp, other metadata).
         
-        k = min(k, len(self.documents))
-        distances, indices = self.index.search(query_embedding_np, k)
+        Timestamps are stored as microseconds since the epoch, 0 when absent.
+        Only naive local times in isoformat() form are converted; any other
+        value, such as one with a UTC offset or a bare date, is kept as is in
+        the other metadata.
+        """
+        other = dict(metadata)
+        type_code = TYPE_CODES.get(other.get("type"), TYPE_OTHER)
+        if type_code != TYPE_OTHER:
+            del other["type"]
+        validated = bool(other.pop("validated", False))
+        timestamp = 0
+        value = other.get("timestamp")
+        if isinstance(value, str):
+            try:
+                moment = datetime.fromisoformat(value)
+            except ValueError:
+                moment = None
+            if moment is not None and moment.tzinfo is None and moment.isoformat() == value:
+                encoded = int(moment.timestamp()) * 1_000_000 + moment.microsecond
+                # Local times skipped or repeated by a DST change do not round-trip
+                if encoded and VectorStore._format_timestamp(encoded) == value:
+                    timestamp = encoded
+                    del other["timestamp"]
+        return type_code, validated, timestamp, other
+    
+    @staticmethod
+    def _format_timestamp(timestamp: int) -> str:
+        """Convert a stored timestamp back to its isoformat() string."""
+        moment = datetime.fromtimestamp(timestamp // 1_000_000)
+        return moment.replace(microsecond=timestamp % 1_000_000).isoformat()
+    
+    def _metadata(self, idx: int) -> Dict[str, Any]:
+        """Rebuild the metadata dict of a document."""
+        metadata = {}
+        if self.meta_type[idx] != TYPE_OTHER:
+            metadata["type"] = DOCUMENT_TYPES[self.meta_type[idx]]
+        metadata["validated"] = bool(self.meta_validated[idx])
+        timestamp = int(self.timestamps[idx])
+        if timestamp:
+            metadata["timestamp"] = self._format_timestamp(timestamp)
+        metadata.update(self.metadata_other[idx])
+        return metadata
+    
+    def _document(self, idx: int) -> Document:
+        """Materialize a document from the columns."""
+        return Document(page_content=self.texts[idx], metadata=self._metadata(idx))
+    
+    def flush(self) -> None:
+        """Write pending changes to disk.
         
-        results = []
-        for i in range(len(indices[0])):
-            idx = indices[0][i]
-            if idx != -1:
-                doc = self.documents[idx]
-                distance = distances[0][i]
-                similarity = 1.0 / (1.0 + distance)
-                results.append((doc, similarity))
+        New documents are appended to the metadata log and the text blob
+        before the offsets are replaced. A rewrite after deletions or a
+        migration replaces every file together through a journal, so a crash
+        never leaves a mix of old and new files.
+        """
+        with self._lock:
+            if not self._dirty:
+                return
+            
+            path = self.index_path
+            if self._rewrite_documents:
+                blob, offsets = self.texts.encode()
+                replace_files({
+                    f"{path}.metadata.jsonl": lambda f: self._write_metadata(f, 0),
+                    f"{path}.columns.npz": self._write_columns,
+                    f"{path}.texts.bin": lambda f: f.write(blob),
+                    f"{path}.offsets.npy": lambda f: np.save(f, offsets),
+                    f"{path}.faiss": self._write_index
+                }, f"{path}.rewrite")
+                self.texts = TextColumn.load(f"{path}.texts.bin", f"{path}.offsets.npy")
+            else:
+                with open(f"{path}.metadata.jsonl", "ab") as f:
+                    self._write_metadata(f, self._persisted_count)
+                replace_file(f"{path}.columns.npz", self._write_columns)
+                self.texts.save(f"{path}.texts.bin", f"{path}.offsets.npy")
+                replace_file(f"{path}.faiss", self._write_index)
+            
+            self._persisted_count = len(self.texts)
+            self._rewrite_documents = False
+            self._dirty = False
+            self._last_flush = time.monotonic()
+    
+    def _write_metadata(self, f: BinaryIO, start: int) -> None:
+        """Write the other metadata from position start as JSON lines."""
+        lines = (json.dumps(other, ensure_ascii=False) + "\n" for other in self.metadata_other[start:])
+        f.write("".join(lines).encode("utf-8"))
+    
+    def _write_columns(self, f: BinaryIO) -> None:
+        """Write the numeric metadata columns as an .npz archive."""
+        np.savez(
+            f,
+            meta_type=self.meta_type,
+            meta_validated=self.meta_validated,
+            timestamps=self.timestamps
+        )
+    
+    def _write_index(self, f: BinaryIO) -> None:
+        """Write the serialized FAISS index."""
+        f.write(faiss.serialize_index(self.index))
+    
+    def _load_columns(self) -> None:
+        """Open the saved document columns, migrating older formats if needed.
+        
+        An interrupted rewrite is completed first. When appending, the offsets
+        file is written last, so it defines how many documents were fully
+        saved; longer columns are truncated to match.
         
-        return results
+        Raises:
+            ValueError: If a saved column holds fewer documents than the texts
+        """
+        path = self.index_path
+        recover_files(f"{path}.rewrite")
+        if not os.path.exists(f"{path}.offsets.npy"):
+            # Files left by a first flush that failed before writing the offsets
+            if os.path.exists(f"{path}.metadata.jsonl"):
+                self._rewrite_documents = True
+            self._append_documents(self._load_legacy_documents())
+            return
+        
+        self.texts = TextColumn.load(f"{path}.texts.bin", f"{path}.offsets.npy")
+        count = len(self.texts)
+        with np.load(f"{path}.columns.npz") as columns:
+            self.meta_type = columns["meta_type"]
+            self.meta_validated = columns["meta_validated"]
+            self.timestamps = columns["timestamps"]
+        with open(f"{path}.metadata.jsonl", encoding="utf-8") as f:
+            lines = f.readlines()
+        # Lines past count may be a partially appended record
+        self.metadata_other = [json.loads(line) for line in lines[:count]]
+        
+        lengths = (len(self.meta_type), len(self.meta_validated), len(self.timestamps), len(lines))
+        if min(lengths) < count:
+            raise ValueError(f"Saved metadata of {path} covers fewer documents than its texts")
+        if max(lengths) > count:
+            self.meta_type = self.meta_type[:count]
+            self.meta_validated = self.meta_validated[:count]
+            self.timestamps = self.timestamps[:count]
+            self._dirty = True
+            self._rewrite_documents = True
+    
+    def _load_legacy_documents(self) -> List[Tuple[str, Dict[str, Any]]]:
+        """Load documents saved as a pickle by earlier versions."""
+        documents = []
+        if os.path.exists(f"{self.index_path}.pkl"):
+            with open(f"{self.index_path}.pkl", "rb") as f:
+                documents = [(doc.page_content, doc.metadata) for doc in pickle.load(f)]
+        
+        if documents:
+            self._dirty = True
+            self._rewrite_documents = True
+        return documents
+    
+    @staticmethod
+    def _new_index() -> faiss.Index:
+        """Create an empty HNSW inner-product index with FP16 storage."""
+        index = faiss.IndexHNSWSQ(
+            EMBEDDING_DIMENSION,
+            faiss.ScalarQuantizer.QT_fp16,
+            HNSW_M,
+            faiss.METRIC_INNER_PRODUCT
+        )
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+        return index
+    
+    @staticmethod
+    def _to_matrix(embeddings: List[List[float]]) -> np.ndarray:
+        """Stack embeddings into an L2-normalized float32 matrix."""
+        embeddings_np = np.array(embeddings, dtype=np.float32)
+        faiss.normalize_L2(embeddings_np)
+        return embeddings_np
+    
+    def _rebuild_index(self) -> None:
+        """Re-embed all documents into a fresh index."""
+        self.index = self._new_index()
+        if self.texts:
+            embeddings = self.embeddings.embed_documents(list(self.texts))
+            self.index.add(self._to_matrix(embeddings))
+        self._dirty = True
     
-    def _save_index(self) -> None:
-        """Save the index and documents to disk."""
-        faiss.write_index(self.index, f"{self.index_path}.faiss")
-        with open(f"{self.index_path}.pkl", "wb") as f:
-            pickle.dump(self.documents, f)
+    def _metadata_mask(self, metadata_key: str, metadata_value: Any) -> np.ndarray:
+        """Flag the documents whose metadata_key equals metadata_value."""
+        if metadata_key == "type" and metadata_value in TYPE_CODES:
+            return self.meta_type == TYPE_CODES[metadata_value]
+        if metadata_key == "validated" and isinstance(metadata_value, bool):
+            return self.meta_validated == metadata_value
+        return np.array(
+            [self._metadata(idx).get(metadata_key) == metadata_value
+             for idx in range(len(self.texts))],
+            dtype=bool
+        )
     
     def delete_by_metadata(self, metadata_key: str, metadata_value: Any) -> None:
         """Delete documents with matching metadata.
@@ -87,18 +470,11 @@ class VectorStore:
             metadata_key: The metadata key to match
             metadata_value: The metadata value to match
         """
-        new_documents = []
-        for doc in self.documents:
-            if doc.metadata.get(metadata_key) != metadata_value:
-                new_documents.append(doc)
-        
-        if len(new_documents) != len(self.documents):
-            self.documents = new_documents
-            self.index = faiss.IndexFlatL2(EMBEDDING_DIMENSION)
-            if new_documents:
-                embeddings = [self.embeddings.embed_query(doc.page_content)
-                              for doc in new_documents]
-                embeddings_np = np.array(embeddings, dtype=np.float32)
-                self.index.add(embeddings_np)
+        with self._lock:
+            keep = ~self._metadata_mask(metadata_key, metadata_value)
             
-            self._save_index()
+            if not keep.all():
+                self._keep_documents(keep)
+                self._rebuild_index()
+                self._rewrite_documents = True
+                self.flush()
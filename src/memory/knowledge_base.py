@@ -1,17 +1,32 @@
-from typing import Dict, Any, List, Tuple, Optional
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, List, Sequence, Tuple, Optional
 from datetime import datetime
 from src.database.vector_store import VectorStore
-from src.config.settings import SIMILARITY_THRESHOLD
+from src.config.settings import PREFERENCE_CACHE_SIZE, SIMILARITY_THRESHOLD
+from src.utils.llm_json import JSON_ARRAY_RE, JSON_OBJECT_RE, parse_llm_json
 
-JSON_CODE_BLOCK = "```json"
+PREFERENCE_KEYWORDS_RE = re.compile(
+    r"\b(prefer\w*|prefir\w*|formal|informal|casual|concis\w*|detail\w*|detalhad\w*|"
+    r"technical|t[eé]cnic\w*|simple|simples|verbose|brief|breve|curt[ao]s?|diret[ao]s?|tone|tom)\b",
+    re.IGNORECASE,
+)
 
 
 class KnowledgeBase:
     """Knowledge base that stores and retrieves information."""
-    def __init__(self):
-        """Initialize the knowledge base."""
-        self.vector_store = VectorStore()
+    def __init__(self, vector_store: Optional[VectorStore] = None):
+        """Initialize the knowledge base.
+
+        Args:
+            vector_store: Vector store to share with other knowledge bases;
+                a new one is created when omitted
+        """
+        self.vector_store = vector_store if vector_store is not None else VectorStore()
         self.user_preferences = {}
+        self._preference_cache: "OrderedDict[str, Optional[Dict[str, Any]]]" = OrderedDict()
+        self._preference_cache_lock = threading.Lock()
     
     def add_fact(self, fact: str, validated: bool = False, source: str = "user") -> bool:
         """Add a validated fact to the knowledge base.
@@ -37,6 +52,20 @@ class KnowledgeBase:
         self.vector_store.add_text(fact, metadata)
         return True
     
+    def add_facts(self, facts: List[str], validated: bool = False, source: str = "user") -> List[str]:
+        """Add several validated facts to the knowledge base in one batch.
+        
+        Args:
+            facts: The facts to add
+            validated: Whether the facts have been validated
+            source: Source of the facts (user, system, etc.)
+            
+        Returns:
+            List of the facts that were added
+        """
+        with self.vector_store.buffered_add():
+            return [fact for fact in facts if self.add_fact(fact, validated, source)]
+    
     def add_preference(self, preference_key: str, preference_value: Any) -> None:
         """Add or update a user preference.
         
@@ -60,32 +89,34 @@ class KnowledgeBase:
         """Get all user preferences.
         
         Returns:
-            Dict of user preferences
+            Copy of the user preferences, safe to iterate while they are updated
         """
-        return self.user_preferences
+        return dict(self.user_preferences)
     
-    def get_relevant_facts(self, query: str, k: int = 3) -> List[str]:
+    def get_relevant_facts(
+        self,
+        query: str,
+        k: int = 3,
+        query_embedding: Optional[Sequence[float]] = None
+    ) -> List[str]:
         """Get facts relevant to the query.
         
         Args:
             query: The query text
             k: Number of results to return
+            query_embedding: Precomputed embedding of the query, if available
             
         Returns:
             List of relevant facts
         """
-        results = self.vector_store.search(query, k)
-        
-        facts = []
-        for doc, score in results:
-            if (
-                doc.metadata.get("type") == "fact" and
-                doc.metadata.get("validated", False) and
-                score > SIMILARITY_THRESHOLD
-            ):
-                facts.append(doc.page_content)
-        
-        return facts
+        return self.vector_store.search_texts(
+            query,
+            k,
+            doc_type="fact",
+            validated=True,
+            min_score=SIMILARITY_THRESHOLD,
+            query_embedding=query_embedding
+        )
     
     def validate_fact(self, fact: str, llm) -> Tuple[bool, str]:
         """Validate if a statement is factual using the LLM.
@@ -112,20 +143,7 @@ class KnowledgeBase:
         """
         response = llm.invoke(prompt)
         try:
-            import json
-            response_text = response.content
-            if JSON_CODE_BLOCK in response_text:
-                json_text = response_text.split(JSON_CODE_BLOCK)[1].split("```")[0].strip()
-            elif "```" in response_text:
-                json_text = response_text.split("```")[1].strip()
-            else:
-                import re
-                json_match = re.search(r'\{.*\}', response_text, re.DOTALL)
-                if json_match:
-                    json_text = json_match.group(0)
-                else:
-                    json_text = response_text
-            result = json.loads(json_text)
+            result = parse_llm_json(response.content, JSON_OBJECT_RE)
             is_valid = result.get("is_factual", False) and result.get("is_accurate", False)
             reason = result.get("reason", "No reason provided")
 
@@ -133,14 +151,80 @@ class KnowledgeBase:
         except Exception as e:
             return False, f"Validation error: {str(e)}"
 
+    def validate_facts_batch(self, facts: List[str], llm) -> List[Tuple[bool, str]]:
+        """Validate several statements with a single LLM call.
+        
+        Args:
+            facts: The facts to validate
+            llm: Language model for validation
+            
+        Returns:
+            List of (is_valid, reason) tuples, in the same order as facts
+        """
+        if not facts:
+            return []
+        
+        statements = "\n".join(f"{i}. \"{fact}\"" for i, fact in enumerate(facts, start=1))
+        prompt = f"""
+        Determine if each of the following statements is factually accurate based on general knowledge.
+        If a statement is a subjective preference, opinion, or a personal experience, indicate that it's not a factual statement.
+        
+        Statements:
+        {statements}
+        
+        Return a JSON array with one object per statement, in the same order, with these fields:
+        - index: the number of the statement
+        - is_factual: true/false (is this a factual claim rather than an opinion or preference)
+        - is_accurate: true/false (if factual, is it generally accurate)
+        - reason: brief explanation
+        
+        Response (JSON array):
+        """
+        response = llm.invoke(prompt)
+        try:
+            results = parse_llm_json(response.content, JSON_ARRAY_RE)
+            
+            validations = [(False, "No assessment provided")] * len(facts)
+            for position, result in enumerate(results):
+                index = result.get("index", position + 1)
+                if isinstance(index, int) and 1 <= index <= len(facts):
+                    is_valid = result.get("is_factual", False) and result.get("is_accurate", False)
+                    reason = result.get("reason", "No reason provided")
+                    validations[index - 1] = (is_valid, reason)
+            
+            return validations
+        except Exception as e:
+            return [(False, f"Validation error: {str(e)}")] * len(facts)
+
     def identify_preference(self, message: str, llm) -> Optional[Dict[str, Any]]:
         """Identify if a message contains a user preference.
+
+        Messages without any preference keyword are rejected without calling
+        the LLM, and results are cached by normalized message.
         Args:
             message: User message
             llm: Language model for preference identification
         Returns:
             Dict with preference information or None
         """
+        if not PREFERENCE_KEYWORDS_RE.search(message):
+            return None
+
+        key = message.lower().strip()
+        with self._preference_cache_lock:
+            if key in self._preference_cache:
+                self._preference_cache.move_to_end(key)
+                return self._preference_cache[key]
+
+        preference = self._identify_preference(message, llm)
+        with self._preference_cache_lock:
+            self._preference_cache[key] = preference
+            if len(self._preference_cache) > PREFERENCE_CACHE_SIZE:
+                self._preference_cache.popitem(last=False)
+        return preference
+
+    def _identify_preference(self, message: str, llm) -> Optional[Dict[str, Any]]:
+        """Ask the LLM whether a message contains a user preference."""
         prompt = f"""
         Determine if the following message contains a user preference about how they want the chatbot to behave.
         Examples of preferences include:
@@ -159,21 +243,7 @@ class KnowledgeBase:
         response = llm.invoke(prompt)
 
         try:
-            import json
-            response_text = response.content
-            if JSON_CODE_BLOCK in response_text:
-                json_text = response_text.split(JSON_CODE_BLOCK)[1].split("```")[0].strip()
-            elif "```" in response_text:
-                json_text = response_text.split("```")[1].strip()
-            else:
-                import re
-                json_match = re.search(r'\{.*\}', response_text, re.DOTALL)
-                if json_match:
-                    json_text = json_match.group(0)
-                else:
-                    json_text = response_text
-                    
-            result = json.loads(json_text)
+            result = parse_llm_json(response.content, JSON_OBJECT_RE)
             
             if result.get("contains_preference", False) and result.get("confidence", 0) > 0.7:
                 return {
@@ -0,0 +1,107 @@
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+import numpy as np
+from src.config.settings import (
+    EMBEDDING_DIMENSION,
+    SEMANTIC_CACHE_SIZE,
+    SEMANTIC_CACHE_THRESHOLD,
+)
+
+
+class SemanticCache:
+    """LRU cache of previous (prompt, response) pairs looked up by cosine similarity.
+
+    Normalized prompt embeddings are kept in a contiguous float32 matrix so a
+    lookup is a single matrix-vector product against every cached entry. An
+    entry only matches when the context it was generated with is identical.
+
+    ChatbotAgent only consults the cache for turns that stand on their own:
+    chat() or stream_chat() called with an empty history and an input without
+    digits. The Streamlit app always sends history and a registro, so its
+    chat path never uses the cache.
+    """
+    def __init__(
+        self,
+        dimension: int = EMBEDDING_DIMENSION,
+        threshold: float = SEMANTIC_CACHE_THRESHOLD,
+        max_entries: int = SEMANTIC_CACHE_SIZE,
+        initial_capacity: int = 64,
+    ):
+        """Initialize the semantic cache.
+        Args:
+            dimension: Dimension of the prompt embeddings
+            threshold: Minimum cosine similarity for a cache hit
+            max_entries: Maximum number of cached responses before eviction
+            initial_capacity: Number of rows preallocated for embeddings
+        """
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.cache_vecs = np.zeros((max(min(initial_capacity, max_entries), 0), dimension), dtype=np.float32)
+        self.cache_entries: List[Tuple[str, str, str]] = []
+        # Slot indices ordered from least to most recently used
+        self._recency: "OrderedDict[int, None]" = OrderedDict()
+
+    def lookup(self, embedding: List[float], context: str = "") -> Optional[str]:
+        """Return the cached response for a semantically similar prompt.
+
+        Args:
+            embedding: Embedding of the current prompt
+            context: Everything besides the prompt that shapes the response
+
+        Returns:
+            The cached response, or None on a cache miss
+        """
+        size = len(self.cache_entries)
+        if not size:
+            return None
+
+        sims = self.cache_vecs[:size] @ self._normalize(embedding)
+        slot = int(sims.argmax())
+        if sims[slot] < self.threshold:
+            return None
+
+        _, response, entry_context = self.cache_entries[slot]
+        if entry_context != context:
+            return None
+
+        self._recency.move_to_end(slot)
+        return response
+
+    def add(self, embedding: List[float], prompt: str, response: str, context: str = "") -> None:
+        """Cache a response, evicting the least recently used entry when full.
+
+        Args:
+            embedding: Embedding of the prompt
+            prompt: The prompt text
+            response: The response generated for the prompt
+            context: Everything besides the prompt that shaped the response
+        """
+        # A size of zero disables the cache
+        if self.max_entries <= 0:
+            return
+
+        if len(self.cache_entries) >= self.max_entries:
+            slot, _ = self._recency.popitem(last=False)
+            self.cache_entries[slot] = (prompt, response, context)
+        else:
+            slot = len(self.cache_entries)
+            if slot == len(self.cache_vecs):
+                self._grow()
+            self.cache_entries.append((prompt, response, context))
+
+        self.cache_vecs[slot] = self._normalize(embedding)
+        self._recency[slot] = None
+
+    def _grow(self) -> None:
+        """Double the embedding buffer, capped at max_entries rows."""
+        capacity = min(max(2 * len(self.cache_vecs), 1), self.max_entries)
+        grown = np.zeros((capacity, self.cache_vecs.shape[1]), dtype=np.float32)
+        grown[:len(self.cache_vecs)] = self.cache_vecs
+        self.cache_vecs = grown
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> np.ndarray:
+        """Convert an embedding to a L2-normalized float32 vector."""
+        embedding_np = np.asarray(embedding, dtype=np.float32).ravel()
+        norm = np.linalg.norm(embedding_np)
+        return embedding_np / norm if norm > 0 else embedding_np
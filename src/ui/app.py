@@ -2,10 +2,11 @@ import streamlit as st
 import asyncio
 import sys
 import os
+import threading
+import httpx
 from pathlib import Path
 from langchain_core.messages import HumanMessage, AIMessage
 from dotenv import load_dotenv
-import tempfile
 
 
 # Add the project root directory to Python path
@@ -13,10 +14,86 @@ project_root = str(Path(__file__).parent.parent.parent)
 sys.path.append(project_root)
 
 from src.agents.chatbot import ChatbotAgent
-from src.utils.pdf_extract import extract_cnh_fields_ocr
+from src.config.settings import HTTP_KEEPALIVE_CONNECTIONS
+from src.database.vector_store import VectorStore
+from src.utils.pdf_extract import extract_cnh_fields_ocr_cached
 
 load_dotenv()
 
+MESSAGE_CLASSES = {"user": HumanMessage, "assistant": AIMessage}
+
+@st.cache_resource
+def get_vector_store():
+    """Load the embedding model and FAISS index once per process, shared by all sessions."""
+    return VectorStore()
+
+@st.cache_resource
+def get_http_clients():
+    """Create the keep-alive HTTP connection pools once per process, shared by all sessions."""
+    limits = httpx.Limits(max_keepalive_connections=HTTP_KEEPALIVE_CONNECTIONS)
+    return httpx.Client(limits=limits), httpx.AsyncClient(limits=limits)
+
+def get_chatbot():
+    """Return this session's agent, built on the shared vector store and HTTP clients.
+
+    Preferences and cached answers live in the agent, so they stay private
+    to the session.
+    """
+    if "chatbot" not in st.session_state:
+        http_client, http_async_client = get_http_clients()
+        st.session_state.chatbot = ChatbotAgent(
+            vector_store=get_vector_store(),
+            http_client=http_client,
+            http_async_client=http_async_client
+        )
+    return st.session_state.chatbot
+
+@st.cache_resource
+def get_event_loop():
+    """Run one event loop in a background thread for all sessions.
+
+    The shared async HTTP client is bound to the loop it first runs on, so
+    every session has to drive its agent from the same loop.
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="chatbot-event-loop", daemon=True).start()
+    return loop
+
+def get_history():
+    """Return the chat as LangChain messages, converting only messages added since the last call."""
+    messages = st.session_state.messages
+    cache = st.session_state.get("history_cache")
+    # Clear Chat swaps in a new list, which invalidates the cache
+    if cache is None or cache["source"] is not messages:
+        cache = st.session_state.history_cache = {"source": messages, "converted": 0, "history": []}
+    cache["history"].extend(
+        MESSAGE_CLASSES[msg["role"]](content=msg["content"])
+        for msg in messages[cache["converted"]:]
+        if msg["role"] in MESSAGE_CLASSES
+    )
+    cache["converted"] = len(messages)
+    return list(cache["history"])
+
+def iterate_in_loop(async_iterator, loop):
+    """Consume an async iterator from synchronous code, one item at a time.
+
+    If the consumer stops early (e.g. a rerun in the middle of a stream), the
+    async iterator is closed on its loop so the in-flight request is released.
+    """
+    try:
+        while True:
+            try:
+                yield asyncio.run_coroutine_threadsafe(async_iterator.__anext__(), loop).result()
+            except StopAsyncIteration:
+                break
+    finally:
+        asyncio.run_coroutine_threadsafe(async_iterator.aclose(), loop)
+
+@st.cache_data(show_spinner=False)
+def extract_cnh_fields(pdf_bytes):
+    """Extract the CNH fields once per PDF content, across Streamlit reruns."""
+    return extract_cnh_fields_ocr_cached(pdf_bytes)
+
 def main():
     """Main function for the Streamlit UI."""
     st.set_page_config(
@@ -30,8 +107,7 @@ def main():
     - Armazenar informações relevantes
     - Validar CNH
     """)
-    if "chatbot" not in st.session_state:
-        st.session_state.chatbot = ChatbotAgent()
+    chatbot = get_chatbot()
     if "messages" not in st.session_state:
         st.session_state.messages = []
     with st.sidebar:
@@ -58,13 +134,9 @@ def main():
     # Add PDF uploader at the top of the main function, before chat input
     uploaded_file = st.file_uploader("Envie sua CNH em PDF", type=["pdf"])
     if uploaded_file is not None:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_file:
-            tmp_file.write(uploaded_file.read())
-            tmp_pdf_path = tmp_file.name
-        st.session_state["uploaded_pdf_path"] = tmp_pdf_path
         st.success("PDF recebido! Verificando se é uma CNH...")
         # Extract CNH fields immediately
-        extracted = extract_cnh_fields_ocr(tmp_pdf_path)
+        extracted = extract_cnh_fields(uploaded_file.getvalue())
         if extracted["registro"]:
             st.info(f"N registro extraído: {extracted['registro']}")
             # Change button to send validation message to chatbot
@@ -83,29 +155,24 @@ def main():
                 hidden_prompt = pdf_message
 
                 # Build conversation history (sem o prompt técnico)
-                history = []
-                for msg in st.session_state.messages:
-                    if msg["role"] == "user":
-                        history.append(HumanMessage(content=msg["content"]))
-                    elif msg["role"] == "assistant":
-                        history.append(AIMessage(content=msg["content"]))
+                history = get_history()
 
                 # Adiciona o prompt técnico só para o LLM
                 history.append(HumanMessage(content=hidden_prompt))
                 prompt = hidden_prompt
 
-                # Call the chatbot and append the response
-                with st.spinner("Pensando..."):
-                    try:
-                        loop = asyncio.new_event_loop()
-                        response = loop.run_until_complete(
-                            st.session_state.chatbot.chat(prompt, history)
-                        )
-                        loop.close()
-                    except Exception as e:
-                        response = f"Ocorreu um erro: {str(e)}"
-                        st.error("Erro ao processar sua mensagem. Veja os logs para mais detalhes.")
-                        print(f"Erro no chatbot: {str(e)}")
+                # Call the chatbot and stream the response
+                with st.chat_message("assistant"):
+                    with st.spinner("Pensando..."):
+                        try:
+                            response = st.write_stream(iterate_in_loop(
+                                chatbot.stream_chat(prompt, history),
+                                get_event_loop()
+                            ))
+                        except Exception as e:
+                            response = f"Ocorreu um erro: {str(e)}"
+                            st.error("Erro ao processar sua mensagem. Veja os logs para mais detalhes.")
+                            print(f"Erro no chatbot: {str(e)}")
 
                     st.session_state.messages.append(
                         {"role": "assistant", "content": response}
@@ -117,17 +184,16 @@ def main():
     with st.sidebar:
         st.header("Learning Status")
 
-        if "chatbot" in st.session_state:
-            preferences = st.session_state.chatbot.knowledge_base.get_preferences()
-
-            st.subheader("User Preferences")
-            if preferences:
-                for pref_type, pref_value in preferences.items():
-                    st.write(f"**{pref_type}:** {pref_value}")
-            else:
-                st.write("No preferences learned yet.")
-            if st.button("View Learned Facts"):
-                st.info("Functionality to display learned facts will be shown here.")
+        preferences = chatbot.knowledge_base.get_preferences()
+
+        st.subheader("User Preferences")
+        if preferences:
+            for pref_type, pref_value in preferences.items():
+                st.write(f"**{pref_type}:** {pref_value}")
+        else:
+            st.write("No preferences learned yet.")
+        if st.button("View Learned Facts"):
+            st.info("Functionality to display learned facts will be shown here.")
 
         if st.button("Clear Chat"):
             st.session_state.messages = []
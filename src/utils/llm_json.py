@@ -0,0 +1,33 @@
+import json
+import re
+from typing import Any, Pattern
+
+JSON_CODE_BLOCK = "```json"
+JSON_ARRAY_RE = re.compile(r'\[.*\]', re.DOTALL)
+JSON_OBJECT_RE = re.compile(r'\{.*\}', re.DOTALL)
+
+
+def parse_llm_json(text: str, pattern: Pattern[str]) -> Any:
+    """Parse the JSON payload of an LLM response.
+
+    Looks for a ```json block, then any ``` block, then the first match of
+    pattern, and finally tries the whole text.
+
+    Args:
+        text: The LLM response text
+        pattern: Compiled pattern matching the expected JSON value
+
+    Returns:
+        The decoded JSON value
+
+    Raises:
+        ValueError: If no valid JSON could be decoded
+    """
+    if JSON_CODE_BLOCK in text:
+        json_text = text.split(JSON_CODE_BLOCK)[1].split("```")[0].strip()
+    elif "```" in text:
+        json_text = text.split("```")[1].strip()
+    else:
+        json_match = pattern.search(text)
+        json_text = json_match.group(0) if json_match else text
+    return json.loads(json_text)
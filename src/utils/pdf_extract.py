@@ -1,64 +1,351 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
 import pdfplumber
 import re
-from pdf2image import convert_from_path
+from pdf2image import convert_from_path, pdfinfo_from_path
 import pytesseract
-from PIL import Image, ImageEnhance, ImageFilter
-import re
+from PIL import Image
+from src.config.settings import (
+    OCR_CACHE_DIR,
+    OCR_CACHE_MAX_ENTRIES,
+    OCR_CACHE_TTL_SECONDS,
+    OCR_TESSDATA_PATH
+)
+
+logger = logging.getLogger(__name__)
+
+# Tesseract's OpenMP threading only adds coordination overhead on single pages
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+try:
+    from tesserocr import OEM, PSM, PyTessBaseAPI
+except ImportError:
+    PyTessBaseAPI = None
+
+# Bump whenever the extraction changes so cached results are recomputed
+OCR_PIPELINE_VERSION = 1
+
+# The MRZ's OCR-B font usually reads at a lower resolution; retry at OCR_DPI otherwise
+MRZ_FAST_DPI = 150
+OCR_DPI = 200
+
+_MRZ_RE = re.compile(r'I<BRA[A-Z0-9<]+')
+# Only correct in the MRZ zone, not the whole OCR text!
+_MRZ_TRANSLATE = str.maketrans({
+    'D': '0',
+    'O': '0',
+    'Q': '0',
+    'I': '1',  # Only if you see this error, otherwise comment out
+    'S': '5',
+    # 'B': '8',  # Uncomment if you see this error
+})
+
+# The MRZ sits in the bottom band of the CNH page
+MRZ_BAND_TOP = 0.82
+MRZ_CHARSET = "ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789<"
+# LSTM-only recognition; point OCR_TESSDATA_PATH at the fast models to speed it up
+TESSERACT_CONFIG = "--oem 1" + (f' --tessdata-dir "{OCR_TESSDATA_PATH}"' if OCR_TESSDATA_PATH else "")
+# The MRZ is a block of three fixed-width lines
+MRZ_TESSERACT_CONFIG = f"{TESSERACT_CONFIG} --psm 6 -c tessedit_char_whitelist={MRZ_CHARSET}"
+
+# Below this many pages a single pytesseract call per page is cheaper than batching
+BATCH_OCR_MIN_PAGES = 2
+
+# Each OCR worker thread keeps its own tesseract API, loaded on first use
+_tess_local = threading.local()
+_ocr_executor = None
+_ocr_executor_lock = threading.Lock()
 
 def preprocess_image(img):
-    # Convert to grayscale
-    img = img.convert('L')
-    # Increase contrast
-    enhancer = ImageEnhance.Contrast(img)
-    img = enhancer.enhance(2)
-    # Optional: sharpen
-    img = img.filter(ImageFilter.SHARPEN)
-    return img
-
-def extract_cnh_fields_ocr(pdf_path):
-    images = convert_from_path(pdf_path)
-    text = ""
-    for img in images:
-        img = preprocess_image(img)
-        text += pytesseract.image_to_string(img, lang="por") + "\n"
+    # Pages are rendered in grayscale already; only convert other inputs
+    if img.mode != 'L':
+        img = img.convert('L')
+    arr = np.asarray(img, dtype=np.uint8)
+    # Binarize with Otsu's threshold; tesseract skips its own thresholding on 1-bit images
+    _, bw = cv2.threshold(arr, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+    return Image.fromarray(bw).convert('1')
+
+def _get_tess_api():
+    """Return the calling thread's tesseract API, loading the model on first use."""
+    api = getattr(_tess_local, "api", None)
+    if api is None:
+        kwargs = {"path": OCR_TESSDATA_PATH} if OCR_TESSDATA_PATH else {}
+        api = _tess_local.api = PyTessBaseAPI(lang="por", psm=PSM.AUTO, oem=OEM.LSTM_ONLY, **kwargs)
+    return api
+
+def _get_ocr_executor():
+    """Return the shared OCR thread pool so worker threads and their models persist."""
+    global _ocr_executor
+    with _ocr_executor_lock:
+        if _ocr_executor is None:
+            _ocr_executor = ThreadPoolExecutor(
+                max_workers=os.cpu_count() or 1,
+                thread_name_prefix="ocr"
+            )
+    return _ocr_executor
+
+def crop_mrz_band(img):
+    """Crop the bottom band of a page, where the MRZ is printed."""
+    width, height = img.size
+    return img.crop((0, int(height * MRZ_BAND_TOP), width, height))
+
+def ocr_image(img, mrz=False):
+    """OCR an image, reusing an in-process tesseract model when tesserocr is installed.
+
+    With mrz set, recognition is restricted to a text block in the MRZ charset.
+    """
+    if PyTessBaseAPI is None:
+        config = MRZ_TESSERACT_CONFIG if mrz else TESSERACT_CONFIG
+        return pytesseract.image_to_string(img, lang="por", config=config)
+
+    api = _get_tess_api()
+    api.SetPageSegMode(PSM.SINGLE_BLOCK if mrz else PSM.AUTO)
+    api.SetVariable("tessedit_char_whitelist", MRZ_CHARSET if mrz else "")
+    api.SetImage(img)
+    return api.GetUTF8Text()
+
+def _ocr_page(img, mrz=False):
+    if mrz:
+        img = crop_mrz_band(img)
+    return ocr_image(preprocess_image(img), mrz)
+
+def _ocr_pages_in_order(images, mrz=False):
+    """Submit pages to the OCR pool as they are produced and yield their texts in page order.
+
+    Closing the generator cancels the pages not yet recognized and stops
+    pulling new ones from images.
+    """
+    executor = _get_ocr_executor()
+    pending = deque()
+    try:
+        for img in images:
+            pending.append(executor.submit(_ocr_page, img, mrz))
+            while pending and pending[0].done():
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+def ocr_images(images, mrz=False):
+    """Preprocess and OCR page images, returning one text per page.
+
+    With tesserocr, pages are recognized in parallel by single-threaded
+    workers; tesseract releases the GIL while recognizing. images may be a
+    lazy iterable, each page is submitted as soon as it is produced. Without it,
+    multi-page inputs go through a single tesseract run over an image-list
+    file so the model is loaded once for all pages.
+
+    With mrz set, only the MRZ band of each page is recognized.
+    """
+    if PyTessBaseAPI is not None:
+        return list(_ocr_pages_in_order(images, mrz))
+
+    if mrz:
+        images = [crop_mrz_band(img) for img in images]
+    images = [preprocess_image(img) for img in images]
+    if len(images) < BATCH_OCR_MIN_PAGES:
+        return [ocr_image(img, mrz) for img in images]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = []
+        for i, img in enumerate(images):
+            path = os.path.join(tmp_dir, f"page_{i}.png")
+            img.save(path, "PNG", optimize=False)
+            paths.append(path)
+        list_path = os.path.join(tmp_dir, "images.txt")
+        with open(list_path, "w") as f:
+            f.write("\n".join(paths))
+        text = pytesseract.image_to_string(
+            list_path, lang="por", config=MRZ_TESSERACT_CONFIG if mrz else TESSERACT_CONFIG
+        )
+    # Tesseract separates the pages of a multi-image run with form feeds
+    return text.split("\f")[:len(images)]
+
+@contextmanager
+def _pdf_path(pdf):
+    """Yield a path to the PDF, writing PDF bytes to a temporary file once for every render."""
+    if not isinstance(pdf, (bytes, bytearray)):
+        yield pdf
+        return
+    with tempfile.NamedTemporaryFile(suffix=".pdf") as f:
+        f.write(pdf)
+        f.flush()
+        yield f.name
+
+def _page_count(pdf_path):
+    return int(pdfinfo_from_path(pdf_path)["Pages"])
+
+def _render_pages(pdf_path, page_count, dpi):
+    """Rasterize the PDF in chunks of one page per render thread, yielding pages in order.
+
+    The OCR pool picks up each chunk's pages while the next chunk renders.
+    """
+    thread_count = max(1, min(os.cpu_count() or 1, page_count))
+    for first_page in range(1, page_count + 1, thread_count):
+        yield from convert_from_path(
+            pdf_path,
+            dpi=dpi,
+            grayscale=True,
+            first_page=first_page,
+            last_page=min(first_page + thread_count - 1, page_count),
+            thread_count=thread_count
+        )
+
+def _collect(items, into):
+    for item in items:
+        into.append(item)
+        yield item
+
+def _ocr_until_mrz(images, mrz=False):
+    """OCR pages in order, stopping after the first page with a well-formed MRZ line.
+
+    Returns:
+        Tuple of (text of the pages read, whether a valid MRZ line was found)
+    """
+    if PyTessBaseAPI is not None:
+        page_texts = _ocr_pages_in_order(images, mrz)
+    else:
+        page_texts = iter(ocr_images(images, mrz))
+
+    parts = []
+    found = False
+    try:
+        for page_text in page_texts:
+            parts.append(page_text)
+            if parse_mrz_registro(page_text):
+                found = True
+                break
+    finally:
+        if hasattr(page_texts, "close"):
+            page_texts.close()
+    # Keep the trailing newline after every page, as the text always had
+    parts.append("")
+    return "\n".join(parts), found
+
+def extract_cnh_fields_ocr(pdf):
+    """Extract the CNH registration number from a PDF given as a path or as bytes."""
+    with _pdf_path(pdf) as pdf_path:
+        page_count = _page_count(pdf_path)
+        # OCR only the MRZ band, first at the fast DPI, then at the full one
+        for dpi in (MRZ_FAST_DPI, OCR_DPI):
+            images = []
+            text, found = _ocr_until_mrz(
+                _collect(_render_pages(pdf_path, page_count, dpi), images), mrz=True
+            )
+            if found:
+                break
+    if not found:
+        # No page had a valid MRZ line in its band; fall back to the full pages
+        text, _ = _ocr_until_mrz(images)
 
     # Extract MRZ-based registration number
-    registro = None
-    mrz_match = re.search(r'I<BRA([A-Z0-9<]+)', text)
-    if mrz_match:
-        mrz_line = mrz_match.group(0)
-        mrz_line = correct_mrz_ocr(mrz_line)
-        value = mrz_line[5:17]
-        registro = value.replace('<', '')
-        
-    print({
-        "registro": registro,
-        "raw_text": text
-    })
+    registro = parse_mrz_registro(text)
+
+    logger.debug("registro=%s len(raw_text)=%d", registro, len(text))
     return {
         "registro": registro,
         "raw_text": text
     }
 
+def extract_cnh_fields_ocr_cached(pdf_bytes):
+    """Extract the CNH fields, reusing registros stored on disk for the same PDF content.
+
+    Only successful extractions are cached, and only their registro: results
+    read from the cache have no raw_text. Entries expire after
+    OCR_CACHE_TTL_SECONDS and at most OCR_CACHE_MAX_ENTRIES are kept.
+    """
+    key = hashlib.sha256(f"v{OCR_PIPELINE_VERSION}:".encode() + pdf_bytes).hexdigest()
+    cache_path = os.path.join(OCR_CACHE_DIR, f"{key}.json")
+    registro = _read_cached_registro(cache_path)
+    if registro:
+        return {"registro": registro, "raw_text": None}
+
+    result = extract_cnh_fields_ocr(pdf_bytes)
+    if result["registro"]:
+        _write_cached_registro(cache_path, result["registro"])
+    return result
+
+def _read_cached_registro(cache_path):
+    try:
+        if time.time() - os.path.getmtime(cache_path) > OCR_CACHE_TTL_SECONDS:
+            os.remove(cache_path)
+            return None
+        with open(cache_path, "r", encoding="utf-8") as f:
+            return json.load(f).get("registro")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def _write_cached_registro(cache_path, registro):
+    tmp_path = None
+    try:
+        os.makedirs(OCR_CACHE_DIR, exist_ok=True)
+        # Write through a temporary file so readers never see a partial entry
+        with tempfile.NamedTemporaryFile(
+            "w", encoding="utf-8", dir=OCR_CACHE_DIR, suffix=".tmp", delete=False
+        ) as f:
+            tmp_path = f.name
+            json.dump({"registro": registro}, f)
+        os.replace(tmp_path, cache_path)
+        tmp_path = None
+        _prune_cache()
+    except OSError:
+        pass
+    finally:
+        if tmp_path is not None:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+def _prune_cache():
+    """Drop expired entries and the oldest ones beyond OCR_CACHE_MAX_ENTRIES."""
+    now = time.time()
+    entries = []
+    for entry in os.scandir(OCR_CACHE_DIR):
+        if not entry.name.endswith(".json"):
+            continue
+        try:
+            mtime = entry.stat().st_mtime
+            if now - mtime > OCR_CACHE_TTL_SECONDS:
+                os.remove(entry.path)
+            else:
+                entries.append((mtime, entry.path))
+        except OSError:
+            continue
+    entries.sort()
+    for _, path in entries[:max(len(entries) - OCR_CACHE_MAX_ENTRIES, 0)]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
 def correct_mrz_ocr(text):
-    # Only correct in the MRZ zone, not the whole OCR text!
-    corrections = str.maketrans({
-        'D': '0',
-        'O': '0',
-        'Q': '0',
-        'I': '1',  # Only if you see this error, otherwise comment out
-        'S': '5',
-        # 'B': '8',  # Uncomment if you see this error
-    })
-    return text.translate(corrections)
+    return text.translate(_MRZ_TRANSLATE)
 
-def extract_cnh_mrz_fields(text):
+def parse_mrz_registro(text):
+    """Return the 11-digit registro from the first well-formed MRZ line in text, or None."""
     # Find the MRZ line (starts with I<BRA)
-    mrz_match = re.search(r'I<BRA([A-Z0-9<]+)', text)
-    if mrz_match:
-        mrz_line = mrz_match.group(0)
-        mrz_line = correct_mrz_ocr(mrz_line)
-        value = mrz_line[5:17]
-        value = value.replace('<', '')
-        return value
-    return None
\ No newline at end of file
+    for mrz_match in _MRZ_RE.finditer(text):
+        mrz_line = correct_mrz_ocr(mrz_match.group(0))
+        # Garbled lines can be too short for the registro field
+        if len(mrz_line) < 17:
+            continue
+        registro = mrz_line[5:17].encode('ascii', 'ignore').translate(None, b'<').decode('ascii')
+        if len(registro) == 11 and registro.isdigit():
+            return registro
+    return None
+
+def extract_cnh_mrz_fields(text):
+    return parse_mrz_registro(text)
\ No newline at end of file
@@ -1,10 +1,43 @@
 import pytest
 import asyncio
-from unittest.mock import MagicMock, patch
-from langchain.schema import HumanMessage
+import gc
+import json
+import os
+import pickle
+import threading
+import time
+import weakref
+import zlib
+from concurrent.futures import Future
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock, patch
+from langchain.schema import AIMessage, HumanMessage
+from langchain_core.documents import Document
+from PIL import Image
 
-from src.agents.chatbot import ChatbotAgent
+from src.agents.chatbot import ChatbotAgent, SYSTEM_PROMPT
+from src.agents.validator import ValidationAgent
+from src.config.settings import EMBEDDING_DIMENSION, MAX_EXTRACTED_FACTS, MAX_HISTORY_LENGTH
+from src.database import text_column, vector_store
+from src.database.text_column import TextColumn
+from src.database.vector_store import VectorStore
 from src.memory.knowledge_base import KnowledgeBase
+from src.memory.semantic_cache import SemanticCache
+from src.utils import pdf_extract
+from src.utils.pdf_extract import (
+    MRZ_BAND_TOP,
+    extract_cnh_fields_ocr,
+    extract_cnh_fields_ocr_cached,
+    ocr_images,
+    parse_mrz_registro,
+)
+
+
+def unit_vector(position):
+    """Build a one-hot embedding."""
+    vector = [0.0] * EMBEDDING_DIMENSION
+    vector[position] = 1.0
+    return vector
 
 
 @pytest.fixture
@@ -12,6 +45,12 @@ def mock_llm():
     """Mock LLM responses."""
     mock = MagicMock()
     mock.invoke.return_value = MagicMock(content="This is a test response")
+    mock.ainvoke = AsyncMock(return_value=MagicMock(content="This is a test response"))
+
+    async def astream(messages):
+        yield MagicMock(content="This is a test response")
+
+    mock.astream = astream
     return mock
 
 
@@ -20,6 +59,9 @@ def chatbot_with_mock_llm(mock_llm):
     """Create a chatbot with a mock LLM."""
     chatbot = ChatbotAgent()
     chatbot.llm = mock_llm
+    chatbot.validator.llm = mock_llm
+    chatbot.knowledge_base.vector_store.embeddings = MagicMock()
+    chatbot.knowledge_base.vector_store.embeddings.embed_query.return_value = unit_vector(0)
     return chatbot
 
 
@@ -42,6 +84,165 @@ class TestChatbotAgent:
         assert isinstance(response, str)
         assert len(response) > 0
 
+    @pytest.mark.asyncio
+    async def test_static_system_prompt_comes_first(self, chatbot_with_mock_llm):
+        """Test that per-turn context does not change the prompt prefix."""
+        # Arrange
+        sent = []
+
+        async def astream(messages):
+            sent.append(messages)
+            yield MagicMock(content="This is a test response")
+
+        chatbot_with_mock_llm.llm.astream = astream
+
+        # Act
+        with patch.object(chatbot_with_mock_llm.knowledge_base, 'get_relevant_facts', return_value=["A fact"]):
+            with patch.object(chatbot_with_mock_llm.knowledge_base, 'identify_preference', return_value=None):
+                await chatbot_with_mock_llm.chat("Hello", [])
+
+        # Assert
+        assert sent[0][0] == {"role": "system", "content": SYSTEM_PROMPT}
+        assert "A fact" in sent[0][-2]["content"]
+
+    @pytest.mark.asyncio
+    async def test_stream_chat_emits_growing_batches(self, chatbot_with_mock_llm):
+        """Test that tokens are streamed in geometrically growing batches and a cache hit at once."""
+        # Arrange
+        async def astream(messages):
+            for _ in range(100):
+                yield MagicMock(content="x")
+
+        chatbot_with_mock_llm.llm.astream = astream
+
+        # Act
+        with patch.object(chatbot_with_mock_llm.knowledge_base, 'get_relevant_facts', return_value=[]):
+            with patch.object(chatbot_with_mock_llm.knowledge_base, 'identify_preference', return_value=None):
+                streamed = [chunk async for chunk in chatbot_with_mock_llm.stream_chat("Hello", [])]
+                cached = [chunk async for chunk in chatbot_with_mock_llm.stream_chat("Hello", [])]
+
+        # Assert
+        assert [len(chunk) for chunk in streamed] == [1, 3, 9, 27, 50, 10]
+        assert cached == ["x" * 100]
+
+    @pytest.mark.asyncio
+    async def test_chat_embeds_input_once(self, chatbot_with_mock_llm):
+        """Test that retrieval and the semantic cache share one embedding."""
+        # Arrange
+        embeddings = chatbot_with_mock_llm.knowledge_base.vector_store.embeddings
+
+        # Act
+        with patch.object(chatbot_with_mock_llm.knowledge_base, 'get_relevant_facts', return_value=[]) as get_facts:
+            with patch.object(chatbot_with_mock_llm.knowledge_base, 'identify_preference', return_value=None):
+                await chatbot_with_mock_llm.chat("Hello", [])
+
+        # Assert
+        embeddings.embed_query.assert_called_once_with("Hello")
+        assert get_facts.call_args.kwargs["query_embedding"] == unit_vector(0)
+
+    @pytest.mark.asyncio
+    async def test_compress_history_keeps_summaries_per_conversation(self, chatbot_with_mock_llm):
+        """Test that summaries are reused within a conversation and not shared across them."""
+        # Arrange
+        chatbot = chatbot_with_mock_llm
+        first = [HumanMessage(content=f"first {i}") for i in range(MAX_HISTORY_LENGTH + 2)]
+        second = [AIMessage(content=f"second {i}") for i in range(MAX_HISTORY_LENGTH + 2)]
+
+        def summarize_by_concatenation(previous, messages):
+            return previous + "".join(message.content for message in messages)
+
+        # Act
+        with patch.object(chatbot, '_summarize', side_effect=summarize_by_concatenation) as summarize:
+            first_summary, _ = await chatbot._compress_history(first)
+            second_summary, _ = await chatbot._compress_history(second)
+            await chatbot._compress_history(first)
+            grown_summary, _ = await chatbot._compress_history(first + [HumanMessage(content="first new")])
+
+        # Assert
+        assert first_summary == "first 0first 1"
+        assert second_summary == "second 0second 1"
+        assert grown_summary == "first 0first 1first 2"
+        assert summarize.call_count == 3
+
+    @pytest.mark.asyncio
+    async def test_semantic_cache_misses_for_different_registro(self, chatbot_with_mock_llm):
+        """Test that prompts differing only in the CNH registro are not served from the cache."""
+        # Arrange
+        sent = []
+
+        async def astream(messages):
+            sent.append(messages)
+            yield MagicMock(content="This is a test response")
+
+        chatbot_with_mock_llm.llm.astream = astream
+        template = "Explique se o número de registro da CNH abaixo é válido:\n{}"
+
+        # Act
+        with patch.object(chatbot_with_mock_llm.knowledge_base, 'get_relevant_facts', return_value=[]):
+            with patch.object(chatbot_with_mock_llm.knowledge_base, 'identify_preference', return_value=None):
+                await chatbot_with_mock_llm.chat(template.format("01234567851"), [])
+                await chatbot_with_mock_llm.chat(template.format("98765432100"), [])
+
+        # Assert
+        assert len(sent) == 2
+
+    @pytest.mark.asyncio
+    async def test_semantic_cache_skips_turns_with_history(self, chatbot_with_mock_llm):
+        """Test that follow-ups are answered by the LLM, while repeated standalone prompts hit the cache."""
+        # Arrange
+        sent = []
+
+        async def astream(messages):
+            sent.append(messages)
+            yield MagicMock(content="This is a test response")
+
+        chatbot_with_mock_llm.llm.astream = astream
+        history = [HumanMessage(content="Previous message"), AIMessage(content="Previous answer")]
+
+        # Act
+        with patch.object(chatbot_with_mock_llm.knowledge_base, 'get_relevant_facts', return_value=[]):
+            with patch.object(chatbot_with_mock_llm.knowledge_base, 'identify_preference', return_value=None):
+                await chatbot_with_mock_llm.chat("Tell me about vector search", [])
+                await chatbot_with_mock_llm.chat("Tell me about vector search", [])
+                await chatbot_with_mock_llm.chat("Tell me about vector search", history)
+
+        # Assert
+        assert len(sent) == 2
+
+    @pytest.mark.asyncio
+    async def test_summarize_does_not_block_the_event_loop(self, chatbot_with_mock_llm):
+        """Test that history summaries use the async LLM call."""
+        # Arrange
+        messages = [HumanMessage(content="An old message")]
+
+        # Act
+        summary = await chatbot_with_mock_llm._summarize("", messages)
+
+        # Assert
+        assert summary == "This is a test response"
+        chatbot_with_mock_llm.llm.ainvoke.assert_awaited_once()
+        chatbot_with_mock_llm.llm.invoke.assert_not_called()
+
+    def test_agents_share_vector_store_but_not_session_state(self):
+        """Test that agents built on shared resources keep preferences and cached answers apart."""
+        # Arrange
+        first = ChatbotAgent()
+
+        # Act
+        second = ChatbotAgent(
+            vector_store=first.knowledge_base.vector_store,
+            http_client=first.http_client,
+            http_async_client=first.http_async_client
+        )
+        with patch.object(first.knowledge_base.vector_store, 'add_text'):
+            first.knowledge_base.add_preference("tone", "formal")
+
+        # Assert
+        assert second.knowledge_base.vector_store is first.knowledge_base.vector_store
+        assert second.http_async_client is first.http_async_client
+        assert second.semantic_cache is not first.semantic_cache
+        assert second.knowledge_base.get_preferences() == {}
+
 
 class TestKnowledgeBase:
     """Tests for the KnowledgeBase class."""
@@ -92,3 +293,689 @@ class TestKnowledgeBase:
         # Assert
         assert kb.user_preferences.get("tone") == "formal"
         kb.vector_store.add_text.assert_called_once()
+
+    def test_validate_facts_batch(self):
+        """Test validating several facts with a single LLM call."""
+        # Arrange
+        kb = KnowledgeBase()
+        llm = MagicMock()
+        llm.invoke.return_value = MagicMock(content="""```json
+        [
+            {"index": 1, "is_factual": true, "is_accurate": true, "reason": "Correct"},
+            {"index": 2, "is_factual": true, "is_accurate": false, "reason": "Incorrect"}
+        ]
+        ```""")
+
+        # Act
+        results = kb.validate_facts_batch(["The Earth orbits the Sun", "The Earth is flat"], llm)
+
+        # Assert
+        assert results == [(True, "Correct"), (False, "Incorrect")]
+        llm.invoke.assert_called_once()
+
+    def test_identify_preference_skips_llm_without_keywords(self):
+        """Test that messages without preference keywords skip the LLM."""
+        # Arrange
+        kb = KnowledgeBase()
+        llm = MagicMock()
+
+        # Act
+        result = kb.identify_preference("What is 2 + 2?", llm)
+
+        # Assert
+        assert result is None
+        llm.invoke.assert_not_called()
+
+    def test_identify_preference_caches_results(self):
+        """Test that repeated preference messages reuse the cached result."""
+        # Arrange
+        kb = KnowledgeBase()
+        llm = MagicMock()
+        llm.invoke.return_value = MagicMock(content="""{
+            "contains_preference": true,
+            "preference_type": "tone",
+            "preference_value": "formal",
+            "confidence": 0.9
+        }""")
+
+        # Act
+        first = kb.identify_preference("I prefer a formal tone", llm)
+        second = kb.identify_preference("  I prefer a FORMAL tone ", llm)
+
+        # Assert
+        assert first == second == {"type": "tone", "value": "formal"}
+        llm.invoke.assert_called_once()
+
+
+class TestValidationAgent:
+    """Tests for the ValidationAgent class."""
+
+    @pytest.mark.parametrize("message", ["hi", "Hello there, how are you", "What should I cook for dinner?"])
+    def test_extract_potential_facts_skips_llm(self, message):
+        """Test that short, greeting and question messages skip the LLM."""
+        # Arrange
+        validator = ValidationAgent(MagicMock())
+        validator.llm = MagicMock()
+
+        # Act
+        facts = validator._extract_potential_facts(message)
+
+        # Assert
+        assert facts == []
+        validator.llm.invoke.assert_not_called()
+
+    def test_extract_potential_facts_caps_results(self):
+        """Test that the number of extracted facts is capped."""
+        # Arrange
+        validator = ValidationAgent(MagicMock())
+        validator.llm = MagicMock()
+        claims = [f"Fact number {i} is true" for i in range(20)]
+        validator.llm.invoke.return_value = MagicMock(content=json.dumps(claims))
+
+        # Act
+        facts = validator._extract_potential_facts("The Earth orbits the Sun and many more things")
+
+        # Assert
+        assert facts == claims[:MAX_EXTRACTED_FACTS]
+
+
+class TestSemanticCache:
+    """Tests for the SemanticCache class."""
+
+    def test_lookup_returns_cached_response_for_similar_prompt(self):
+        """Test that a similar prompt hits the cache."""
+        # Arrange
+        cache = SemanticCache()
+        cache.add(unit_vector(0), "What is FAISS?", "A vector search library")
+
+        # Act
+        response = cache.lookup(unit_vector(0))
+
+        # Assert
+        assert response == "A vector search library"
+
+    def test_lookup_misses_for_unrelated_prompt(self):
+        """Test that an unrelated prompt misses the cache."""
+        # Arrange
+        cache = SemanticCache()
+        cache.add(unit_vector(0), "What is FAISS?", "A vector search library")
+
+        # Act
+        response = cache.lookup(unit_vector(1))
+
+        # Assert
+        assert response is None
+
+    def test_add_evicts_least_recently_used_entry(self):
+        """Test that the oldest entry is evicted when the cache is full."""
+        # Arrange
+        cache = SemanticCache(max_entries=2)
+        cache.add(unit_vector(0), "first", "first response")
+        cache.add(unit_vector(1), "second", "second response")
+        cache.lookup(unit_vector(0))
+
+        # Act
+        cache.add(unit_vector(2), "third", "third response")
+
+        # Assert
+        assert cache.lookup(unit_vector(0)) == "first response"
+        assert cache.lookup(unit_vector(1)) is None
+        assert cache.lookup(unit_vector(2)) == "third response"
+
+    def test_add_grows_embedding_buffer(self):
+        """Test that the embedding buffer grows past its initial capacity."""
+        # Arrange
+        cache = SemanticCache(initial_capacity=1)
+
+        # Act
+        for position in range(3):
+            cache.add(unit_vector(position), f"prompt {position}", f"response {position}")
+
+        # Assert
+        assert len(cache.cache_vecs) >= 3
+        assert [cache.lookup(unit_vector(p)) for p in range(3)] == [
+            "response 0", "response 1", "response 2"
+        ]
+
+    def test_lookup_misses_for_different_context(self):
+        """Test that an entry only matches the context it was generated with."""
+        # Arrange
+        cache = SemanticCache()
+        cache.add(unit_vector(0), "How should you answer?", "Formally", context="tone: formal")
+
+        # Act
+        response = cache.lookup(unit_vector(0), context="tone: casual")
+
+        # Assert
+        assert response is None
+
+    def test_zero_size_disables_cache(self):
+        """Test that a cache with no capacity stores nothing and never hits."""
+        # Arrange
+        cache = SemanticCache(max_entries=0)
+
+        # Act
+        cache.add(unit_vector(0), "What is FAISS?", "A vector search library")
+
+        # Assert
+        assert cache.lookup(unit_vector(0)) is None
+
+
+class FakeEmbeddings:
+    """Deterministic one-hot embeddings keyed by the text."""
+
+    def embed_documents(self, texts):
+        """Embed each text."""
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text):
+        """Embed a text as the one-hot vector at its CRC32 position."""
+        return unit_vector(zlib.crc32(text.encode("utf-8")) % EMBEDDING_DIMENSION)
+
+
+@pytest.fixture
+def store_path(tmp_path, monkeypatch):
+    """Point a vector store at a temporary directory with fake embeddings."""
+    monkeypatch.setattr(vector_store, "LocalEmbeddings", FakeEmbeddings)
+    return str(tmp_path / "vector_index")
+
+
+@pytest.fixture
+def local_timezone(monkeypatch):
+    """Run a test with a local timezone behind UTC."""
+    monkeypatch.setenv("TZ", "America/Sao_Paulo")
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+DOCUMENTS = [
+    ("User likes coffee", {"type": "preference", "validated": True}),
+    ("Paris is in França", {"type": "fact", "validated": True, "timestamp": "2024-01-02T03:04:05.000006"}),
+    ("The sky is green", {"type": "fact", "validated": False, "source": "chat"}),
+    ("Note without a known type", {"type": "note", "validated": False}),
+]
+
+
+def stored_documents(store):
+    """Materialize every document of a store in order."""
+    return [(store.texts[idx], store._metadata(idx)) for idx in range(len(store.texts))]
+
+
+class TestVectorStore:
+    """Tests for the VectorStore persistence."""
+
+    def test_round_trip_keeps_texts_metadata_and_search_aligned(self, store_path):
+        """Test that documents survive add, flush, delete and reload in step."""
+        # Arrange
+        store = VectorStore(store_path)
+        with store.buffered_add():
+            for text, metadata in DOCUMENTS:
+                store.add_text(text, metadata)
+        store.flush()
+
+        # Act
+        reloaded = VectorStore(store_path)
+        reloaded.delete_by_metadata("type", "preference")
+        after_delete = VectorStore(store_path)
+
+        # Assert
+        assert stored_documents(reloaded) == DOCUMENTS[1:]
+        assert stored_documents(after_delete) == stored_documents(reloaded)
+        for text, metadata in DOCUMENTS[1:]:
+            [(document, score)] = after_delete.search(text, k=1)
+            assert document == Document(page_content=text, metadata=metadata)
+            assert score == pytest.approx(1.0, abs=1e-3)
+        assert after_delete.search_texts("User likes coffee", k=3, doc_type="preference") == []
+
+    def test_buffered_add_only_queues_the_calling_threads_adds(self, store_path):
+        """Test that another thread's add_text is not held back by an open buffered_add block."""
+        # Arrange
+        store = VectorStore(store_path)
+
+        # Act
+        with store.buffered_add():
+            store.add_text(*DOCUMENTS[0])
+            other_thread = threading.Thread(target=store.add_text, args=DOCUMENTS[1])
+            other_thread.start()
+            other_thread.join()
+            during_block = stored_documents(store)
+
+        # Assert
+        assert during_block == DOCUMENTS[1:2]
+        assert stored_documents(store) == [DOCUMENTS[1], DOCUMENTS[0]]
+
+    def test_add_is_persisted_once_the_interval_elapses(self, store_path, monkeypatch):
+        """Test that adds are only written to disk by the debounced flush."""
+        # Arrange
+        monkeypatch.setattr(vector_store, "PERSIST_INTERVAL_SECONDS", 3600)
+        store = VectorStore(store_path)
+
+        # Act
+        store.add_text(*DOCUMENTS[0])
+        before_interval = os.path.exists(f"{store_path}.offsets.npy")
+        monkeypatch.setattr(vector_store, "PERSIST_INTERVAL_SECONDS", 0)
+        store.add_text(*DOCUMENTS[1])
+
+        # Assert
+        assert not before_interval
+        assert stored_documents(VectorStore(store_path)) == DOCUMENTS[:2]
+
+    def test_legacy_pickle_is_migrated(self, store_path):
+        """Test that documents saved as a pickle are converted to the columns."""
+        # Arrange
+        with open(f"{store_path}.pkl", "wb") as f:
+            pickle.dump([Document(page_content=t, metadata=m) for t, m in DOCUMENTS], f)
+
+        # Act
+        VectorStore(store_path).flush()
+        migrated = VectorStore(store_path)
+
+        # Assert
+        assert stored_documents(migrated) == DOCUMENTS
+        assert migrated.index.ntotal == len(DOCUMENTS)
+
+    @pytest.mark.parametrize("timestamp", [
+        "2024-01-02T03:04:05",
+        "2024-01-02T03:04:05.000006",
+        "2024-01-02T03:04:05+00:00",
+        "2024-01-02",
+        "2024-01-02 03:04:05",
+        "not a date",
+    ])
+    def test_timestamps_round_trip_unchanged(self, store_path, local_timezone, timestamp):
+        """Test that every timestamp string comes back exactly as it was added."""
+        # Arrange
+        store = VectorStore(store_path)
+
+        # Act
+        store.add_text("dated", {"type": "fact", "validated": True, "timestamp": timestamp})
+        store.flush()
+        reloaded = VectorStore(store_path)
+
+        # Assert
+        assert stored_documents(reloaded) == [
+            ("dated", {"type": "fact", "validated": True, "timestamp": timestamp})
+        ]
+
+    def test_interrupted_rewrite_is_completed_on_load(self, store_path):
+        """Test that a rewrite which crashed before swapping its files is rolled forward."""
+        # Arrange
+        store = VectorStore(store_path)
+        with store.buffered_add():
+            for text, metadata in DOCUMENTS:
+                store.add_text(text, metadata)
+        store.flush()
+
+        # Act
+        with patch.object(text_column, 'recover_files'):
+            store.delete_by_metadata("type", "preference")
+        reloaded = VectorStore(store_path)
+
+        # Assert
+        assert stored_documents(reloaded) == DOCUMENTS[1:]
+        assert reloaded.index.ntotal == len(DOCUMENTS) - 1
+        assert not os.path.exists(f"{store_path}.rewrite")
+
+    def test_load_drops_partially_appended_metadata(self, store_path):
+        """Test that metadata appended past the saved texts is discarded."""
+        # Arrange
+        store = VectorStore(store_path)
+        store.add_text(*DOCUMENTS[0])
+        store.flush()
+        with open(f"{store_path}.metadata.jsonl", "a", encoding="utf-8") as f:
+            f.write('{"sou')
+
+        # Act
+        reloaded = VectorStore(store_path)
+        reloaded.flush()
+
+        # Assert
+        assert stored_documents(reloaded) == DOCUMENTS[:1]
+        with open(f"{store_path}.metadata.jsonl", encoding="utf-8") as f:
+            assert len(f.readlines()) == 1
+
+    def test_load_discards_files_of_a_failed_first_flush(self, store_path):
+        """Test that metadata appended by a first flush that never completed is not reused."""
+        # Arrange
+        store = VectorStore(store_path)
+        store.add_text("first", {"type": "fact", "validated": True, "source": "A"})
+        with patch.object(TextColumn, 'save', side_effect=OSError("disk full")):
+            with pytest.raises(OSError):
+                store.flush()
+
+        # Act
+        restarted = VectorStore(store_path)
+        restarted.add_text(*DOCUMENTS[1])
+        restarted.flush()
+
+        # Assert
+        assert stored_documents(VectorStore(store_path)) == DOCUMENTS[1:2]
+
+    def test_load_refuses_metadata_shorter_than_texts(self, store_path):
+        """Test that missing metadata rows are reported instead of misaligned."""
+        # Arrange
+        store = VectorStore(store_path)
+        store.add_text(*DOCUMENTS[0])
+        store.add_text(*DOCUMENTS[1])
+        store.flush()
+        with open(f"{store_path}.metadata.jsonl", "r+", encoding="utf-8") as f:
+            first_line = f.readline()
+            f.seek(0)
+            f.truncate()
+            f.write(first_line)
+
+        # Act / Assert
+        with pytest.raises(ValueError):
+            VectorStore(store_path)
+
+    def test_exit_flush_does_not_keep_stores_alive(self, store_path):
+        """Test that only open stores are flushed at exit and dropped ones are freed."""
+        # Arrange
+        closed, dropped = VectorStore(store_path), VectorStore(store_path)
+        dropped_ref = weakref.ref(dropped)
+
+        # Act
+        closed.add_text(*DOCUMENTS[0])
+        closed.close()
+        del dropped
+        gc.collect()
+
+        # Assert
+        assert closed not in vector_store._open_stores
+        assert dropped_ref() is None
+        assert stored_documents(VectorStore(store_path)) == DOCUMENTS[:1]
+
+    def test_text_column_round_trips_utf8_texts(self, tmp_path):
+        """Test that appended and rewritten texts decode back unchanged."""
+        # Arrange
+        blob_path, offsets_path = str(tmp_path / "texts.bin"), str(tmp_path / "offsets.npy")
+        column = TextColumn(["ação", ""])
+        column.save(blob_path, offsets_path)
+        column.extend(["日本語", "plain"])
+
+        # Act
+        column.save(blob_path, offsets_path)
+        loaded = TextColumn.load(blob_path, offsets_path)
+        blob, offsets = loaded.encode()
+
+        # Assert
+        assert list(loaded) == ["ação", "", "日本語", "plain"]
+        assert loaded[-1] == "plain"
+        assert blob == "ação日本語plain".encode("utf-8")
+        assert list(offsets) == list(loaded._offsets)
+
+
+@pytest.fixture
+def ocr_cache_dir(tmp_path, monkeypatch):
+    """Point the OCR result cache at a temporary directory."""
+    monkeypatch.setattr(pdf_extract, "OCR_CACHE_DIR", str(tmp_path))
+    return tmp_path
+
+
+class TestPdfExtract:
+    """Tests for the CNH extraction pipeline."""
+
+    def test_parse_mrz_registro_corrects_ocr_confusions(self):
+        """Test that the registro is read from a well-formed MRZ line."""
+        # Act
+        registro = parse_mrz_registro("CARTEIRA\nI<BRAO12345678S1<<<<<<<<<\n")
+
+        # Assert
+        assert registro == "01234567851"
+
+    @pytest.mark.parametrize("text", ["I<BRA123<<", "I<BRA1234567890<<<<<", "no MRZ here"])
+    def test_parse_mrz_registro_rejects_malformed_lines(self, text):
+        """Test that short or non 11-digit MRZ fields are rejected."""
+        # Act
+        registro = parse_mrz_registro(text)
+
+        # Assert
+        assert registro is None
+
+    def test_cached_extraction_stores_only_the_registro(self, ocr_cache_dir):
+        """Test that a successful extraction is cached without the OCR text."""
+        # Arrange
+        result = {"registro": "01234567851", "raw_text": "NOME FULANO\nI<BRA..."}
+
+        # Act
+        with patch.object(pdf_extract, 'extract_cnh_fields_ocr', return_value=result) as extract:
+            first = extract_cnh_fields_ocr_cached(b"%PDF-1")
+            second = extract_cnh_fields_ocr_cached(b"%PDF-1")
+
+        # Assert
+        extract.assert_called_once()
+        assert first["registro"] == second["registro"] == "01234567851"
+        [entry] = list(ocr_cache_dir.glob("*.json"))
+        assert json.loads(entry.read_text()) == {"registro": "01234567851"}
+
+    def test_cached_extraction_retries_failures(self, ocr_cache_dir):
+        """Test that extractions without a registro are not cached."""
+        # Arrange
+        result = {"registro": None, "raw_text": ""}
+
+        # Act
+        with patch.object(pdf_extract, 'extract_cnh_fields_ocr', return_value=result) as extract:
+            extract_cnh_fields_ocr_cached(b"%PDF-1")
+            extract_cnh_fields_ocr_cached(b"%PDF-1")
+
+        # Assert
+        assert extract.call_count == 2
+        assert list(ocr_cache_dir.iterdir()) == []
+
+    def test_cached_extraction_expires_and_bounds_entries(self, ocr_cache_dir, monkeypatch):
+        """Test that stale entries are recomputed and the oldest ones evicted."""
+        # Arrange
+        monkeypatch.setattr(pdf_extract, "OCR_CACHE_MAX_ENTRIES", 2)
+        result = {"registro": "01234567851", "raw_text": ""}
+
+        # Act
+        with patch.object(pdf_extract, 'extract_cnh_fields_ocr', return_value=result) as extract:
+            extract_cnh_fields_ocr_cached(b"%PDF-1")
+            for entry in ocr_cache_dir.glob("*.json"):
+                os.utime(entry, (0, 0))
+            extract_cnh_fields_ocr_cached(b"%PDF-1")
+            extract_cnh_fields_ocr_cached(b"%PDF-2")
+            extract_cnh_fields_ocr_cached(b"%PDF-3")
+
+        # Assert
+        assert extract.call_count == 4
+        assert len(list(ocr_cache_dir.glob("*.json"))) == 2
+
+    def test_cached_extraction_removes_temp_file_on_failed_write(self, ocr_cache_dir):
+        """Test that a failed cache write does not leave a temporary file behind."""
+        # Arrange
+        result = {"registro": "01234567851", "raw_text": ""}
+
+        # Act
+        with patch.object(pdf_extract, 'extract_cnh_fields_ocr', return_value=result):
+            with patch.object(pdf_extract.os, 'replace', side_effect=OSError("disk full")):
+                extracted = extract_cnh_fields_ocr_cached(b"%PDF-1")
+
+        # Assert
+        assert extracted == result
+        assert list(ocr_cache_dir.iterdir()) == []
+
+
+MRZ_LINE = "I<BRAO12345678S1<<<<<<<<<"
+
+
+def page_image(page, height=200):
+    """Build a blank page whose width encodes its page number."""
+    return Image.new("L", (100 + page, height), 255)
+
+
+def band_height(height):
+    """Height of the MRZ band cropped from a page."""
+    return height - int(height * MRZ_BAND_TOP)
+
+
+class FakeTessAPI:
+    """Tesseract API answering with the text configured for each (page, image height)."""
+
+    def __init__(self, texts):
+        self.texts = texts
+        self.calls = []
+        self.mrz = False
+
+    def SetPageSegMode(self, psm):
+        self.mrz = psm == "single_block"
+
+    def SetVariable(self, name, value):
+        pass
+
+    def SetImage(self, img):
+        self.img = img
+
+    def GetUTF8Text(self):
+        page = self.img.width - 100
+        self.calls.append((page, self.img.size, self.img.mode, self.mrz))
+        return self.texts.get((page, self.img.height), "")
+
+
+class InlineExecutor:
+    """Executor running each task as it is submitted."""
+
+    def submit(self, fn, *args):
+        future = Future()
+        future.set_result(fn(*args))
+        return future
+
+
+@pytest.fixture
+def fake_tesserocr(monkeypatch):
+    """Route OCR through a fake in-process tesseract API, one page at a time."""
+    def install(texts):
+        api = FakeTessAPI(texts)
+        monkeypatch.setattr(pdf_extract, "PyTessBaseAPI", object)
+        monkeypatch.setattr(pdf_extract, "PSM", SimpleNamespace(AUTO="auto", SINGLE_BLOCK="single_block"), raising=False)
+        monkeypatch.setattr(pdf_extract, "_get_tess_api", lambda: api)
+        monkeypatch.setattr(pdf_extract, "_get_ocr_executor", InlineExecutor)
+        return api
+    return install
+
+
+@pytest.fixture
+def rendered_pages(monkeypatch):
+    """Render two blank pages at the requested DPI, recording each page and PDF read."""
+    rendered = SimpleNamespace(pages=[], pdf_reads=[], page_counts=[])
+
+    def page_count(pdf_path):
+        rendered.page_counts.append(pdf_path)
+        return 2
+
+    def render(pdf_path, page_count, dpi):
+        with open(pdf_path, "rb") as f:
+            rendered.pdf_reads.append((pdf_path, f.read()))
+        for page in range(page_count):
+            rendered.pages.append((dpi, page))
+            yield page_image(page, height=dpi)
+
+    monkeypatch.setattr(pdf_extract, "_page_count", page_count)
+    monkeypatch.setattr(pdf_extract, "_render_pages", render)
+    return rendered
+
+
+class TestOcrPipeline:
+    """Tests for the CNH OCR pipeline."""
+
+    def test_extract_stops_at_first_page_with_mrz(self, fake_tesserocr, rendered_pages):
+        """Test that only the MRZ band is read and later pages are never rendered."""
+        # Arrange
+        api = fake_tesserocr({(0, band_height(150)): MRZ_LINE})
+
+        # Act
+        result = extract_cnh_fields_ocr(b"%PDF-1")
+
+        # Assert
+        assert result["registro"] == "01234567851"
+        assert rendered_pages.pages == [(150, 0)]
+        assert api.calls == [(0, (100, band_height(150)), "1", True)]
+
+    def test_extract_retries_mrz_band_at_full_dpi(self, fake_tesserocr, rendered_pages):
+        """Test that a page set without a readable MRZ is rendered again at OCR_DPI."""
+        # Arrange
+        api = fake_tesserocr({(1, band_height(200)): MRZ_LINE})
+
+        # Act
+        result = extract_cnh_fields_ocr(b"%PDF-1")
+
+        # Assert
+        assert result["registro"] == "01234567851"
+        assert rendered_pages.pages == [(150, 0), (150, 1), (200, 0), (200, 1)]
+        assert all(mrz for *_, mrz in api.calls)
+        [(pdf_path, _), (second_path, _)] = rendered_pages.pdf_reads
+        assert rendered_pages.page_counts == [pdf_path] == [second_path]
+        assert [content for _, content in rendered_pages.pdf_reads] == [b"%PDF-1", b"%PDF-1"]
+        assert not os.path.exists(pdf_path)
+
+    def test_extract_falls_back_to_full_pages_without_mrz(self, fake_tesserocr, rendered_pages):
+        """Test that full pages are only read when no MRZ band had a valid line."""
+        # Arrange
+        api = fake_tesserocr({(1, 200): f"NOME FULANO\n{MRZ_LINE}\n"})
+
+        # Act
+        result = extract_cnh_fields_ocr(b"%PDF-1")
+
+        # Assert
+        assert result["registro"] == "01234567851"
+        assert [call for call in api.calls if not call[3]] == [
+            (0, (100, 200), "1", False),
+            (1, (101, 200), "1", False),
+        ]
+        assert len(api.calls) == 6
+
+    def test_ocr_images_batches_pages_through_an_image_list(self, monkeypatch):
+        """Test that pytesseract reads all pages in one run, split on form feeds."""
+        # Arrange
+        monkeypatch.setattr(pdf_extract, "PyTessBaseAPI", None)
+        sizes = []
+
+        def image_to_string(image_list, lang, config):
+            with open(image_list) as f:
+                for path in f.read().splitlines():
+                    with Image.open(path) as img:
+                        sizes.append(img.size)
+            return "".join(f"page {i}\f" for i in range(len(sizes)))
+
+        # Act
+        with patch.object(pdf_extract.pytesseract, 'image_to_string', side_effect=image_to_string) as ocr:
+            texts = ocr_images([page_image(page) for page in range(3)], mrz=True)
+
+        # Assert
+        ocr.assert_called_once()
+        assert texts == ["page 0", "page 1", "page 2"]
+        assert sizes == [(100 + page, band_height(200)) for page in range(3)]
+
+    def test_ocr_images_reads_a_single_page_directly(self, monkeypatch):
+        """Test that one page is passed to pytesseract as an image, without a list file."""
+        # Arrange
+        monkeypatch.setattr(pdf_extract, "PyTessBaseAPI", None)
+
+        # Act
+        with patch.object(pdf_extract.pytesseract, 'image_to_string', return_value="page 0") as ocr:
+            texts = ocr_images([page_image(0)])
+
+        # Assert
+        assert texts == ["page 0"]
+        assert isinstance(ocr.call_args.args[0], Image.Image)
+
+    def test_render_pages_converts_in_chunks(self, monkeypatch):
+        """Test that pages are rasterized one chunk per render thread count, in order."""
+        # Arrange
+        monkeypatch.setattr(pdf_extract.os, "cpu_count", lambda: 2)
+        chunks = []
+
+        def convert(pdf_path, dpi, grayscale, first_page, last_page, thread_count):
+            chunks.append((pdf_path, first_page, last_page, thread_count))
+            return [page_image(page) for page in range(first_page - 1, last_page)]
+
+        monkeypatch.setattr(pdf_extract, "convert_from_path", convert)
+
+        # Act
+        pages = list(pdf_extract._render_pages("cnh.pdf", 5, dpi=150))
+
+        # Assert
+        assert chunks == [("cnh.pdf", 1, 2, 2), ("cnh.pdf", 3, 4, 2), ("cnh.pdf", 5, 5, 2)]
+        assert [img.width - 100 for img in pages] == [0, 1, 2, 3, 4]